@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from video_blur_core import VideoBlurrer, ModelCache, MEDIAPIPE_AVAILABLE, peak_rss_mb
+
+BLUR_TYPES = ("gaussian", "fast_gaussian", "box", "pixelate", "mosaic")
+KERNEL_SIZES = (15, 51, 101)
+REGION_SIZES = (64, 256)
+RESOLUTIONS = ((640, 360), (1280, 720), (1920, 1080))
+LENGTHS = (60, 300)
+SECTIONS = ("blur_region", "process_frame", "process_video")
+
+# Synthetic objects use colours the background never contains, so the stub
+# detectors can find them again with a colour threshold
+FACE_COLOR = (90, 140, 210)
+PLATE_COLOR = (245, 245, 245)
+COLOR_TOLERANCE = 30
+
+
+def _bounce(value: float, limit: int) -> int:
+    if limit <= 0:
+        return 0
+    value = value % (2 * limit)
+    return int(value if value <= limit else 2 * limit - value)
+
+
+class SyntheticScene:
+    """Noisy gradient background with face-like patches and plates moving across it"""
+    
+    def __init__(self, width: int, height: int, objects: int = 4, seed: int = 0):
+        self.width = width
+        self.height = height
+        rng = np.random.default_rng(seed)
+        
+        x = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+        y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+        background = np.empty((height, width, 3), dtype=np.float32)
+        background[..., 0] = 40 + 80 * x + 10 * y
+        background[..., 1] = 60 + 40 * y
+        background[..., 2] = 25 + 40 * (1 - x)
+        background += rng.normal(0, 4, background.shape)
+        self.background = np.clip(background, 0, 255).astype(np.uint8)
+        
+        base = min(width, height)
+        self.objects = []
+        for index in range(objects):
+            if index % 2 == 0:
+                box_w = int(base * rng.uniform(0.08, 0.18))
+                box_h = int(box_w * 1.3)
+                kind = "face"
+            else:
+                box_w = int(base * rng.uniform(0.15, 0.3))
+                box_h = max(8, box_w // 4)
+                kind = "plate"
+            position = rng.uniform((0, 0), (max(1, width - box_w), max(1, height - box_h)))
+            velocity = rng.uniform(-1.0, 1.0, 2) * base * 0.01
+            self.objects.append((kind, box_w, box_h, position, velocity))
+    
+    def boxes(self, index: int) -> List[Tuple[str, Tuple[int, int, int, int]]]:
+        boxes = []
+        for kind, box_w, box_h, (x, y), (vx, vy) in self.objects:
+            x1 = _bounce(x + vx * index, self.width - box_w)
+            y1 = _bounce(y + vy * index, self.height - box_h)
+            boxes.append((kind, (x1, y1, x1 + box_w, y1 + box_h)))
+        return boxes
+    
+    def frame(self, index: int) -> np.ndarray:
+        frame = self.background.copy()
+        for kind, (x1, y1, x2, y2) in self.boxes(index):
+            box_w, box_h = x2 - x1, y2 - y1
+            if kind == "face":
+                center = ((x1 + x2) // 2, (y1 + y2) // 2)
+                cv2.ellipse(frame, center, (box_w // 2, box_h // 2), 0, 0, 360, FACE_COLOR, -1)
+                for side in (-1, 1):
+                    eye = (center[0] + side * box_w // 5, center[1] - box_h // 8)
+                    cv2.circle(frame, eye, max(1, box_w // 10), (40, 40, 40), -1)
+                cv2.line(
+                    frame,
+                    (center[0] - box_w // 6, center[1] + box_h // 5),
+                    (center[0] + box_w // 6, center[1] + box_h // 5),
+                    (60, 60, 120), max(1, box_h // 30)
+                )
+            else:
+                cv2.rectangle(frame, (x1, y1), (x2 - 1, y2 - 1), PLATE_COLOR, -1)
+                cv2.putText(
+                    frame, "AB 123", (x1 + box_w // 10, y2 - box_h // 4),
+                    cv2.FONT_HERSHEY_SIMPLEX, box_h / 45.0, (30, 30, 30), max(1, box_h // 15)
+                )
+        return frame
+
+
+def make_synthetic_video(path: str, width: int, height: int, frames: int, fps: float = 30.0, seed: int = 0) -> str:
+    """Write a synthetic clip to path, reusing it if it already exists"""
+    if os.path.exists(path):
+        return path
+    
+    scene = SyntheticScene(width, height, seed=seed)
+    temp_path = f"{os.path.splitext(path)[0]}.partial.mp4"
+    writer = cv2.VideoWriter(temp_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not write synthetic video: {path}")
+    try:
+        for index in range(frames):
+            writer.write(scene.frame(index))
+    finally:
+        writer.release()
+    os.replace(temp_path, path)
+    return path
+
+
+def _color_boxes(frame: np.ndarray, color: Tuple[int, int, int], min_area: int = 16) -> List[Tuple[int, int, int, int]]:
+    lower = np.clip(np.array(color) - COLOR_TOLERANCE, 0, 255).astype(np.uint8)
+    upper = np.clip(np.array(color) + COLOR_TOLERANCE, 0, 255).astype(np.uint8)
+    contours, _ = cv2.findContours(cv2.inRange(frame, lower, upper), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w * h >= min_area:
+            boxes.append((x, y, x + w, y + h))
+    return boxes
+
+
+class _HostArray(np.ndarray):
+    """ndarray answering the .cpu()/.numpy() calls made on YOLO result tensors"""
+    
+    def cpu(self):
+        return self
+    
+    def numpy(self):
+        return np.asarray(self)
+
+
+class StubYOLO:
+    """Stands in for an ultralytics model and finds the synthetic objects by colour"""
+    
+    def __init__(self, colors: List[Tuple[int, int, int]], latency: float = 0.0):
+        self.colors = colors
+        self.latency = latency
+    
+    def __call__(self, frames: List[np.ndarray], conf: float = 0.25, iou: float = 0.5, verbose: bool = False):
+        if self.latency:
+            time.sleep(self.latency * len(frames))
+        results = []
+        for frame in frames:
+            boxes = [
+                SimpleNamespace(
+                    xyxy=np.array([box], dtype=np.float32).view(_HostArray),
+                    conf=np.array([0.9], dtype=np.float32)
+                )
+                for color in self.colors
+                for box in _color_boxes(frame, color)
+            ]
+            results.append(SimpleNamespace(boxes=boxes))
+        return results
+
+
+class StubFaceDetection:
+    """Stands in for MediaPipe face detection and finds the synthetic faces by colour"""
+    
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+    
+    def process(self, rgb_frame: np.ndarray):
+        if self.latency:
+            time.sleep(self.latency)
+        h, w = rgb_frame.shape[:2]
+        detections = []
+        for x1, y1, x2, y2 in _color_boxes(rgb_frame, FACE_COLOR[::-1]):
+            bbox = SimpleNamespace(xmin=x1 / w, ymin=y1 / h, width=(x2 - x1) / w, height=(y2 - y1) / h)
+            detections.append(SimpleNamespace(location_data=SimpleNamespace(relative_bounding_box=bbox)))
+        return SimpleNamespace(detections=detections)
+
+
+def make_blurrer(detectors: str = "stub", device: str = "cpu", stub_latency: float = 0.0, **options) -> VideoBlurrer:
+    if detectors == "real":
+        return VideoBlurrer(device=device, **options)
+    if int(options.get('segments', 1)) > 1:
+        # Segment workers are separate processes that build their own model cache and would load real weights
+        raise ValueError("segments > 1 needs --detectors real; stub detectors cannot reach the segment workers")
+    
+    # The blurrer borrows its detectors from the model cache, so seeding it swaps in the stubs
+    device = "cpu"
+    cache = ModelCache()
+    detect_faces = options.get('detect_faces', True)
+    cache.get(("mediapipe", "face_detection", options.get('confidence', 0.15)), lambda: StubFaceDetection(stub_latency))
+    yolo_colors = []
+    if detect_faces and not MEDIAPIPE_AVAILABLE:
+        yolo_colors.append(FACE_COLOR)
+    if options.get('detect_license_plates', True):
+        yolo_colors.append(PLATE_COLOR)
+    cache.get(("yolo", "yolo11n.pt", device), lambda: StubYOLO(yolo_colors, stub_latency))
+    return VideoBlurrer(device=device, model_cache=cache, **options)
+
+
+def _time_calls(fn, repeat: int, warmup: int = 2) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _timings(samples: List[float]) -> dict:
+    samples_ms = np.array(samples) * 1000
+    mean = float(samples_ms.mean())
+    return {
+        'calls': len(samples),
+        'mean_ms': round(mean, 4),
+        'median_ms': round(float(np.median(samples_ms)), 4),
+        'p95_ms': round(float(np.percentile(samples_ms, 95)), 4),
+        'throughput': round(1000 / mean, 2) if mean > 0 else None
+    }
+
+
+def bench_blur_region(repeat: int = 50, resolution: Tuple[int, int] = (1280, 720)) -> List[dict]:
+    width, height = resolution
+    frame = SyntheticScene(width, height).frame(0)
+    results = []
+    for blur_type in BLUR_TYPES:
+        for kernel in KERNEL_SIZES:
+            blurrer = VideoBlurrer(
+                device="cpu", blur_type=blur_type, blur_strength=kernel,
+                detect_faces=False, detect_license_plates=False
+            )
+            for size in REGION_SIZES:
+                x1, y1 = (width - size) // 2, (height - size) // 2
+                bbox = (x1, y1, x1 + size, y1 + size)
+                work = frame.copy()
+                samples = _time_calls(lambda: blurrer.blur_region(work, bbox), repeat)
+                results.append(dict(
+                    name=f"blur_region/{blur_type}/k{blurrer.blur_strength}/{size}px",
+                    blur_type=blur_type,
+                    kernel_size=blurrer.blur_strength,
+                    region_size=size,
+                    **_timings(samples)
+                ))
+                print(f"  {results[-1]['name']}: {results[-1]['mean_ms']:.3f} ms")
+    return results
+
+
+def bench_process_frame(
+    resolutions,
+    frames: int = 30,
+    detectors: str = "stub",
+    device: str = "cpu",
+    stub_latency: float = 0.0,
+    options: Optional[dict] = None
+) -> List[dict]:
+    results = []
+    for width, height in resolutions:
+        scene = SyntheticScene(width, height)
+        clips = [scene.frame(index) for index in range(frames)]
+        blurrer = make_blurrer(detectors, device, stub_latency, **(options or {}))
+        blurrer.process_frame(clips[0].copy())
+        
+        samples = []
+        for clip in clips:
+            frame = clip.copy()
+            start = time.perf_counter()
+            blurrer.process_frame(frame)
+            samples.append(time.perf_counter() - start)
+        
+        results.append(dict(name=f"process_frame/{width}x{height}", width=width, height=height, **_timings(samples)))
+        print(f"  {results[-1]['name']}: {results[-1]['throughput']} FPS")
+    return results
+
+
+def _run_process_video(
+    input_path: str,
+    output_path: str,
+    detectors: str,
+    device: str,
+    stub_latency: float,
+    options: dict
+) -> dict:
+    blurrer = make_blurrer(detectors, device, stub_latency, profile=True, **options)
+    start = time.perf_counter()
+    success, message = blurrer.process_video(input_path, output_path)
+    wall_seconds = time.perf_counter() - start
+    memory = peak_rss_mb()
+    return {
+        'success': success,
+        'message': message,
+        'frames': blurrer.frames_processed,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput': round(blurrer.frames_processed / wall_seconds, 2) if wall_seconds > 0 else None,
+        'peak_rss_mb': memory['process'] if memory else None,
+        'performance': blurrer.performance_report
+    }
+
+
+def bench_process_video(
+    resolutions,
+    lengths,
+    work_dir: str,
+    detectors: str = "stub",
+    device: str = "cpu",
+    stub_latency: float = 0.0,
+    options: Optional[dict] = None
+) -> List[dict]:
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for width, height in resolutions:
+        for length in lengths:
+            input_path = make_synthetic_video(
+                os.path.join(work_dir, f"synthetic_{width}x{height}_{length}.mp4"), width, height, length
+            )
+            output_path = os.path.join(work_dir, "output.mp4")
+            # A fresh process per run, so peak memory belongs to this run alone
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(
+                    _run_process_video, input_path, output_path, detectors, device, stub_latency, options or {}
+                ).result()
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            
+            results.append(dict(
+                name=f"process_video/{width}x{height}/{length}f",
+                width=width,
+                height=height,
+                length=length,
+                **result
+            ))
+            print(f"  {results[-1]['name']}: {result['throughput']} FPS, peak RSS {result['peak_rss_mb']} MB")
+    return results
+
+
+def environment(args, options: dict) -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'detectors': args.detectors,
+        'device': args.device,
+        'stub_latency_ms': args.stub_latency_ms,
+        'options': options
+    }
+
+
+def compare(previous_path: str, results: dict):
+    """Print the throughput change of every case also present in an earlier run"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    baseline = {
+        case['name']: case.get('throughput')
+        for section in SECTIONS for case in previous.get(section, [])
+    }
+    
+    print(f"\nCompared with {previous_path} ({previous.get('environment', {}).get('commit')}):")
+    for section in SECTIONS:
+        for case in results.get(section, []):
+            old, new = baseline.get(case['name']), case.get('throughput')
+            if not old or new is None:
+                continue
+            print(f"  {case['name']:<45} {old:>10.2f} -> {new:>10.2f}  {new / old - 1:+.1%}")
+
+
+def _parse_size(text: str) -> Tuple[int, int]:
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def _parse_option(text: str) -> Tuple[str, object]:
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark DefaceIT on synthetic videos. Uses stub detectors unless --detectors real is given, "
+                    "so it runs without model weights or network access."
+    )
+    parser.add_argument('--output', default='benchmark_results.json', help="where to write the JSON results")
+    parser.add_argument('--compare', metavar='JSON', help="earlier results to compare throughput against")
+    parser.add_argument('--only', action='append', choices=SECTIONS, help="run only these benchmarks")
+    parser.add_argument('--detectors', choices=('stub', 'real'), default='stub')
+    parser.add_argument('--device', default='cpu', help="device for real detectors")
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0, help="simulated inference time per frame")
+    parser.add_argument(
+        '--resolutions', type=lambda text: [_parse_size(size) for size in text.split(',')],
+        default=list(RESOLUTIONS), help="e.g. 640x360,1280x720"
+    )
+    parser.add_argument(
+        '--lengths', type=lambda text: [int(length) for length in text.split(',')],
+        default=list(LENGTHS), help="frame counts of the process_video clips, e.g. 60,300"
+    )
+    parser.add_argument('--repeat', type=int, default=50, help="calls per blur_region case")
+    parser.add_argument('--frames', type=int, default=30, help="frames per process_frame case")
+    parser.add_argument(
+        '--option', action='append', default=[], type=_parse_option, metavar='NAME=VALUE',
+        help="VideoBlurrer argument for process_frame and process_video, e.g. batch_size=8 or pipeline=true"
+    )
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'defaceit_benchmark'),
+                        help="where synthetic videos are generated and kept between runs")
+    parser.add_argument('--quick', action='store_true', help="smallest resolution and length, fewer repeats")
+    args = parser.parse_args()
+    
+    if args.quick:
+        args.resolutions = args.resolutions[:1]
+        args.lengths = args.lengths[:1]
+        args.repeat = min(args.repeat, 10)
+        args.frames = min(args.frames, 10)
+    
+    options = dict(args.option)
+    if args.detectors == "stub" and int(options.get('segments', 1)) > 1:
+        parser.error("--option segments=N with N > 1 needs --detectors real; "
+                     "stub detectors cannot reach the segment worker processes")
+    sections = args.only or SECTIONS
+    stub_latency = args.stub_latency_ms / 1000
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = {'environment': environment(args, options)}
+    
+    if "blur_region" in sections:
+        print("blur_region")
+        results['blur_region'] = bench_blur_region(args.repeat)
+    if "process_frame" in sections:
+        print("process_frame")
+        results['process_frame'] = bench_process_frame(
+            args.resolutions, args.frames, args.detectors, args.device, stub_latency, options
+        )
+    if "process_video" in sections:
+        print("process_video")
+        results['process_video'] = bench_process_video(
+            args.resolutions, args.lengths, args.work_dir, args.detectors, args.device, stub_latency, options
+        )
+    
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class JobStore:
+    """Job records kept in memory and persisted to SQLite so they survive restarts"""
+
+    UNFINISHED = ('queued', 'processing')
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._versions = {}
+        self._jobs = {}
+        self._flushed_at = {}
+        self._conn = None
+
+    def _connect(self):
+        # Opened lazily so importing the web app does not require the data folder
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._conn.commit()
+            for job_id, data in self._conn.execute('SELECT job_id, data FROM jobs'):
+                self._jobs[job_id] = json.loads(data)
+        return self._conn
+
+    def _flush(self, job_id):
+        job = self._jobs[job_id]
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO jobs (job_id, status, data, updated_at) VALUES (?, ?, ?, ?)',
+            (job_id, job['status'], json.dumps(job), now)
+        )
+        self._conn.commit()
+        self._flushed_at[job_id] = now
+
+    def create(self, job_id, job):
+        with self._lock:
+            self._connect()
+            self._jobs[job_id] = dict(job)
+            self._flush(job_id)
+
+    def get(self, job_id):
+        """Copy of the job record, or None"""
+        with self._lock:
+            self._connect()
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, **fields):
+        """Status changes are written at once; progress updates at most every flush_interval"""
+        with self._lock:
+            self._connect()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            status_changed = 'status' in fields and fields['status'] != job['status']
+            job.update(fields)
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            self._changed.notify_all()
+            if status_changed or time.time() - self._flushed_at.get(job_id, 0) >= self.flush_interval:
+                self._flush(job_id)
+
+    def delete(self, job_id):
+        with self._lock:
+            self._connect().execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+            self._conn.commit()
+            self._jobs.pop(job_id, None)
+            self._flushed_at.pop(job_id, None)
+            self._versions.pop(job_id, None)
+            self._changed.notify_all()
+
+    def wait_for_update(self, job_id, version, timeout):
+        """Block until the job changes from version (or timeout); returns (version, job)"""
+        with self._changed:
+            self._connect()
+            self._changed.wait_for(
+                lambda: self._versions.get(job_id, 0) != version or job_id not in self._jobs,
+                timeout
+            )
+            return self._versions.get(job_id, 0), self.get(job_id)
+
+    def items(self):
+        """Copies of all (job_id, job) pairs"""
+        with self._lock:
+            self._connect()
+            return [(job_id, dict(job)) for job_id, job in self._jobs.items()]
+
+    def unfinished(self):
+        """(job_id, job) pairs that were queued or running when the server stopped"""
+        with self._lock:
+            self._connect()
+            return [
+                (job_id, dict(job)) for job_id, job in self._jobs.items()
+                if job['status'] in self.UNFINISHED
+            ]
+
+    def __contains__(self, job_id):
+        with self._lock:
+            self._connect()
+            return job_id in self._jobs
@@ -5,9 +5,21 @@ import numpy as np
 from ultralytics import YOLO
 from pathlib import Path
 from typing import List, Tuple, Optional
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from fractions import Fraction
 import time
 import subprocess
 import os
+import sys
+import queue
+import threading
+import json
+import tempfile
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
 
 try:
     try:
@@ -27,6 +39,820 @@ except ImportError:
     MEDIAPIPE_NEW_API = False
 
 
+DETECTION_FACE = 1
+DETECTION_LICENSE_PLATE = 2
+DETECTION_TRACKED = 4
+
+ROLE_FLAGS = {
+    "face": DETECTION_FACE,
+    "license_plate": DETECTION_LICENSE_PLATE,
+}
+
+Detection = Tuple[Tuple[int, int, int, int], int]
+
+
+def _create_face_detector(confidence: float):
+    if MEDIAPIPE_NEW_API:
+        return mp_face_detection.FaceDetection(
+            model_selection=1,
+            min_detection_confidence=confidence
+        )
+    return mp.solutions.face_detection.FaceDetection(
+        model_selection=1,
+        min_detection_confidence=confidence
+    )
+
+
+def _load_yolo(weights: str, device: str):
+    model = YOLO(weights)
+    model.to(device)
+    return model
+
+
+class ModelCache:
+    """Thread-safe LRU cache of loaded detectors shared between jobs.
+    
+    Entries are (model, lock) pairs; callers must hold the lock while
+    running inference, since neither YOLO nor MediaPipe are safe to call
+    from several threads at once.
+    
+    Models load outside the cache lock, so a cold load only blocks callers
+    waiting for that same key.
+    """
+    
+    def __init__(self, max_size: int = 4):
+        self.max_size = max(1, int(max_size))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: tuple, loader):
+        with self._lock:
+            future = self._entries.get(key)
+            loading = future is None
+            if loading:
+                future = self._entries[key] = Future()
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+        
+        if loading:
+            try:
+                future.set_result((loader(), threading.Lock()))
+            except BaseException as e:
+                # Drop the failed entry so the next caller retries the load
+                with self._lock:
+                    if self._entries.get(key) is future:
+                        del self._entries[key]
+                future.set_exception(e)
+                raise
+        return future.result()
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+def _ffprobe_stream(path: str, select_streams: str, entries: str, extra_args: Optional[List[str]] = None) -> dict:
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', select_streams,
+        '-show_entries', entries if ':' in entries else f'stream={entries}',
+        '-of', 'json'
+    ] + (extra_args or []) + [path]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except FileNotFoundError:
+        return {}
+    if result.returncode != 0:
+        return {}
+    try:
+        streams = json.loads(result.stdout).get('streams', [])
+    except ValueError:
+        return {}
+    return streams[0] if streams else {}
+
+
+def probe_video(path: str) -> Optional[dict]:
+    stream = _ffprobe_stream(
+        path, 'v:0',
+        'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration:stream_tags=rotate:stream_side_data=rotation'
+    )
+    if not stream.get('width') or not stream.get('height'):
+        return None
+    
+    width, height = int(stream['width']), int(stream['height'])
+    rotation = stream.get('tags', {}).get('rotate')
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+    
+    fps = 0.0
+    for key in ('avg_frame_rate', 'r_frame_rate'):
+        try:
+            rate = Fraction(stream.get(key, '0/0'))
+        except (ValueError, ZeroDivisionError):
+            continue
+        if rate > 0:
+            fps = float(rate)
+            break
+    
+    frame_count = int(stream['nb_frames']) if str(stream.get('nb_frames', '')).isdigit() else 0
+    if frame_count == 0:
+        counted = _ffprobe_stream(path, 'v:0', 'nb_read_packets', ['-count_packets'])
+        if str(counted.get('nb_read_packets', '')).isdigit():
+            frame_count = int(counted['nb_read_packets'])
+    if frame_count == 0 and fps > 0:
+        try:
+            frame_count = int(round(float(stream.get('duration', 0)) * fps))
+        except ValueError:
+            pass
+    
+    return {'width': width, 'height': height, 'fps': fps, 'frame_count': frame_count}
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_detections(path: str, detections: List[List[Detection]]):
+    offsets = np.zeros(len(detections) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(frame_detections) for frame_detections in detections])
+    boxes = np.array(
+        [bbox for frame_detections in detections for bbox, _ in frame_detections],
+        dtype=np.int32
+    ).reshape(-1, 4)
+    flags = np.array(
+        [flags for frame_detections in detections for _, flags in frame_detections],
+        dtype=np.uint8
+    )
+    
+    fd, temp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, offsets=offsets, boxes=boxes, flags=flags)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load_detections(path: str) -> Optional[List[List[Detection]]]:
+    try:
+        with np.load(path) as data:
+            offsets = data['offsets']
+            boxes = data['boxes'].tolist()
+            flags = data['flags'].tolist()
+    except (OSError, KeyError, ValueError):
+        return None
+    
+    return [
+        [(tuple(boxes[i]), flags[i]) for i in range(offsets[n], offsets[n + 1])]
+        for n in range(len(offsets) - 1)
+    ]
+
+
+def video_info(path: str) -> Optional[dict]:
+    info = probe_video(path)
+    if info:
+        return info
+    
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        return None
+    info = {
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'fps': cap.get(cv2.CAP_PROP_FPS),
+        'frame_count': int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    }
+    cap.release()
+    return info
+
+
+class FFmpegReader:
+    """Decodes a video with a multi-threaded ffmpeg into reusable BGR buffers.
+    
+    Frames handed out by read() are owned by the caller until passed back
+    to recycle(), after which their memory is reused for later frames.
+    
+    When input_complete is given, input_path is still being written (e.g.
+    an upload in progress): it is followed and piped into ffmpeg until the
+    event is set, and error is set if it stops growing for stall_timeout.
+    """
+    
+    def __init__(
+        self,
+        input_path: str,
+        width: int,
+        height: int,
+        threads: int = 0,
+        input_complete: Optional[threading.Event] = None,
+        stall_timeout: float = 120.0
+    ):
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * 3
+        self.error = None
+        self._free = deque()
+        self._released = False
+        self.process = subprocess.Popen(
+            [
+                'ffmpeg',
+                '-loglevel', 'error',
+                '-threads', str(threads),
+                '-i', input_path if input_complete is None else 'pipe:0',
+                '-map', '0:v:0',
+                '-f', 'rawvideo',
+                '-pix_fmt', 'bgr24',
+                '-vsync', 'passthrough',
+                'pipe:1'
+            ],
+            stdin=subprocess.DEVNULL if input_complete is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        self._feeder = None
+        if input_complete is not None:
+            self._feeder = threading.Thread(
+                target=self._feed,
+                args=(input_path, input_complete, stall_timeout),
+                daemon=True
+            )
+            self._feeder.start()
+    
+    def _feed(self, input_path: str, input_complete: threading.Event, stall_timeout: float):
+        last_growth = time.time()
+        try:
+            with open(input_path, 'rb') as f:
+                while not self._released:
+                    # Checked before reading so data written just before the event is not missed
+                    complete = input_complete.is_set()
+                    chunk = f.read(1 << 20)
+                    if chunk:
+                        self.process.stdin.write(chunk)
+                        last_growth = time.time()
+                    elif complete:
+                        break
+                    elif time.time() - last_growth > stall_timeout:
+                        self.error = f"Input stopped growing for {stall_timeout:.0f}s before it was complete"
+                        break
+                    else:
+                        time.sleep(0.1)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+    
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        frame = self._free.popleft() if self._free else np.empty((self.height, self.width, 3), dtype=np.uint8)
+        view = memoryview(frame).cast('B')
+        filled = 0
+        while filled < self.frame_size:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        
+        if filled < self.frame_size:
+            self._free.append(frame)
+            return False, None
+        return True, frame
+    
+    def grab(self) -> bool:
+        ret, frame = self.read()
+        if ret:
+            self.recycle(frame)
+        return ret
+    
+    def recycle(self, frame: np.ndarray):
+        if frame.shape == (self.height, self.width, 3) and frame.dtype == np.uint8 and frame.flags.c_contiguous:
+            self._free.append(frame)
+    
+    def release(self):
+        self._released = True
+        if self.process.stdout:
+            self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        if self._feeder is not None:
+            self._feeder.join()
+
+
+class FFmpegWriter:
+    """Streams raw BGR frames into a single ffmpeg process.
+    
+    When audio_source is given, its first audio stream (if any) is muxed
+    into the output by the same process, optionally through audio_filter.
+    
+    output_format "fragmented_mp4" and "hls" write output that can be read
+    while encoding is still running: keyframes are forced every
+    segment_duration seconds, and for HLS output_path is the playlist with
+    the segments written next to it.
+    """
+    
+    def __init__(
+        self,
+        output_path: str,
+        fps: float,
+        width: int,
+        height: int,
+        audio_source: Optional[str] = None,
+        audio_filter: Optional[str] = None,
+        codec: str = "libx264",
+        preset: Optional[str] = "medium",
+        crf: Optional[int] = 23,
+        output_format: str = "mp4",
+        segment_duration: float = 4.0,
+        audio_codec: str = "aac"
+    ):
+        cmd = [
+            'ffmpeg',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}',
+            '-r', str(fps),
+            '-i', 'pipe:0'
+        ]
+        
+        if audio_source:
+            cmd += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?']
+            if audio_filter:
+                cmd += ['-af', audio_filter]
+            cmd += ['-c:a', audio_codec, '-shortest']
+        
+        # yuv420p needs even dimensions, so odd-sized frames get a one pixel border
+        if width % 2 or height % 2:
+            cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        cmd += ['-c:v', codec]
+        if preset:
+            cmd += ['-preset', preset]
+        if crf is not None:
+            cmd += ['-crf', str(crf)]
+        if output_format != "mp4":
+            cmd += ['-force_key_frames', f'expr:gte(t,n_forced*{segment_duration})']
+        if output_format == "fragmented_mp4":
+            cmd += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+        elif output_format == "hls":
+            stem = os.path.splitext(output_path)[0]
+            cmd += [
+                '-f', 'hls',
+                '-hls_time', str(segment_duration),
+                '-hls_playlist_type', 'event',
+                '-hls_segment_filename', f'{stem}_%05d.ts'
+            ]
+        cmd += ['-pix_fmt', 'yuv420p', '-y', output_path]
+        
+        self.error = None
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=self._stderr
+        )
+    
+    def write(self, frame: np.ndarray):
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            self.release()
+            raise RuntimeError(f"ffmpeg encoder exited: {self.error or 'broken pipe'}")
+    
+    def release(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        if self.process.wait() != 0 and self.error is None:
+            self._stderr.seek(0)
+            self.error = self._stderr.read().decode(errors='replace').strip() or f"exit code {self.process.returncode}"
+        self._stderr.close()
+
+
+class _InferenceRequest:
+    
+    def __init__(self, frames: List[np.ndarray], conf: float, iou: float, client=None):
+        self.frames = frames
+        self.conf = conf
+        self.iou = iou
+        self.client = client
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class _ModelBatcher:
+    
+    # A client that has not submitted for this long (stalled on a growing
+    # upload, or reusing cached detections) is no longer waited for
+    CLIENT_IDLE_SECONDS = 1.0
+    
+    def __init__(self, model, lock, max_batch_size: int, max_wait: float, name=None, observer=None):
+        self.model = model
+        self.lock = lock
+        self.name = name
+        self.observer = observer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.users = 0
+        self._last_seen = {}
+        self._pending = deque()
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+    
+    def detach(self, client):
+        with self._condition:
+            self._last_seen.pop(client, None)
+            self._condition.notify()
+    
+    def infer(self, frames: List[np.ndarray], conf: float, iou: float, client=None):
+        request = _InferenceRequest(frames, conf, iou, client)
+        with self._condition:
+            self._pending.append(request)
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+    
+    def _ready(self) -> bool:
+        pending_frames = sum(len(request.frames) for request in self._pending)
+        if pending_frames >= self.max_batch_size:
+            return True
+        # Every recently active job is blocked on a request, so nothing else can arrive soon
+        now = time.monotonic()
+        waiting = {request.client for request in self._pending}
+        if None not in waiting and all(
+            client in waiting for client, seen in self._last_seen.items()
+            if now - seen < self.CLIENT_IDLE_SECONDS
+        ):
+            return True
+        return time.monotonic() >= self._pending[0].created + self.max_wait
+    
+    def _take_batch(self) -> List[_InferenceRequest]:
+        batch = []
+        frame_count = 0
+        iou = self._pending[0].iou
+        while self._pending and self._pending[0].iou == iou:
+            request = self._pending[0]
+            if batch and frame_count + len(request.frames) > self.max_batch_size:
+                break
+            batch.append(self._pending.popleft())
+            frame_count += len(request.frames)
+        return batch
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                while not self._ready():
+                    self._condition.wait(max(0.0, self._pending[0].created + self.max_wait - time.monotonic()))
+                batch = self._take_batch()
+            
+            seconds = None
+            try:
+                frames = [frame for request in batch for frame in request.frames]
+                with self.lock:
+                    start = time.perf_counter()
+                    results = list(self.model(
+                        frames,
+                        conf=min(request.conf for request in batch),
+                        iou=batch[0].iou,
+                        verbose=False
+                    ))
+                    seconds = time.perf_counter() - start
+                offset = 0
+                for request in batch:
+                    request.results = results[offset:offset + len(request.frames)]
+                    offset += len(request.frames)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                with self._condition:
+                    finished = time.monotonic()
+                    for request in batch:
+                        if request.client is not None:
+                            self._last_seen[request.client] = finished
+                for request in batch:
+                    request.done.set()
+            
+            if seconds is not None and self.observer is not None:
+                try:
+                    self.observer(self.name, seconds, len(frames))
+                except Exception as e:
+                    print(f"Inference observer failed: {e}")
+
+
+class InferenceService:
+    """Batches frames from concurrent jobs into shared YOLO forward passes.
+    
+    Requests for the same model are merged until max_batch_size frames are
+    waiting, every job that submitted within the last second has a request
+    in flight, or max_wait seconds pass. Jobs identify themselves with the
+    client argument; attached jobs that are not sending frames are not
+    waited for. The batch runs with the lowest confidence among its requests;
+    callers filter boxes by their own threshold.
+    
+    A model's batcher lives while jobs are attached or requests are in
+    flight, so models evicted from the model cache can be freed.
+    
+    observer, if set, is called with (name, seconds, frames) after every
+    forward pass; seconds covers only the model call, not the time requests
+    spend queued for a batch.
+    """
+    
+    def __init__(self, max_batch_size: int = 16, max_wait: float = 0.01, observer=None):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait
+        self.observer = observer
+        self._batchers = {}
+        self._lock = threading.Lock()
+    
+    def _observe(self, name, seconds: float, frames: int):
+        observer = self.observer
+        if observer is not None:
+            observer(name, seconds, frames)
+    
+    def _acquire(self, model, lock, name=None) -> _ModelBatcher:
+        with self._lock:
+            batcher = self._batchers.get(id(model))
+            if batcher is None or batcher.model is not model:
+                batcher = _ModelBatcher(model, lock, self.max_batch_size, self.max_wait, name, self._observe)
+                self._batchers[id(model)] = batcher
+            if batcher.name is None:
+                batcher.name = name
+            batcher.users += 1
+            return batcher
+    
+    def _release(self, batcher: _ModelBatcher):
+        with self._lock:
+            batcher.users -= 1
+            if batcher.users > 0:
+                return
+            if self._batchers.get(id(batcher.model)) is batcher:
+                del self._batchers[id(batcher.model)]
+        batcher.stop()
+    
+    def attach(self, model, lock, name=None):
+        self._acquire(model, lock, name)
+    
+    def detach(self, model, lock, client=None):
+        with self._lock:
+            batcher = self._batchers.get(id(model))
+        if batcher is None or batcher.model is not model:
+            return
+        batcher.detach(client)
+        self._release(batcher)
+    
+    def infer(self, model, lock, frames: List[np.ndarray], conf: float, iou: float = 0.5, name=None, client=None):
+        batcher = self._acquire(model, lock, name)
+        try:
+            return batcher.infer(frames, conf, iou, client)
+        finally:
+            self._release(batcher)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._batchers)
+
+
+shared_model_cache = ModelCache(max_size=int(os.environ.get("DEFACEIT_MODEL_CACHE_SIZE", "4")))
+shared_inference_service = InferenceService(
+    max_batch_size=int(os.environ.get("DEFACEIT_INFERENCE_BATCH_SIZE", "16")),
+    max_wait=float(os.environ.get("DEFACEIT_INFERENCE_MAX_WAIT_MS", "10")) / 1000.0
+)
+
+# Audio codecs that can be stream-copied into each output container (None: any)
+AUDIO_COPY_CODECS = {
+    '.mp4': {'aac', 'mp3', 'ac3', 'eac3', 'alac'},
+    '.mov': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'pcm_s16le'},
+    '.mkv': None,
+    '.m3u8': {'aac', 'mp3', 'ac3', 'eac3'},
+    '.avi': {'mp3', 'ac3', 'pcm_s16le'},
+    '.flv': {'aac', 'mp3'},
+}
+
+def peak_rss_mb() -> Optional[dict]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'process': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+    }
+
+
+class StageProfiler:
+    """Wall time per processing stage, detections per frame and peak memory.
+    
+    Safe to share between the pipeline threads and the audio worker; stages
+    that run concurrently overlap, so their times can add up to more than
+    the wall time. observer, if given, is called with (stage, seconds) for
+    every timed call.
+    """
+    
+    def __init__(self, observer=None):
+        self.observer = observer
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._detections = {}
+        self._start = time.perf_counter()
+    
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(name, seconds)
+            if self.observer is not None:
+                self.observer(name, seconds)
+    
+    def add(self, name: str, seconds: float, calls: int = 1):
+        with self._lock:
+            totals = self._stages.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += calls
+    
+    def count_detections(self, counts):
+        with self._lock:
+            for count in counts:
+                self._detections[count] = self._detections.get(count, 0) + 1
+    
+    def merge(self, report: dict):
+        """Add the stage times and detections of another report, e.g. from a segment worker"""
+        for name, stage in report.get('stages', {}).items():
+            self.add(name, stage['seconds'], stage['calls'])
+        with self._lock:
+            for count, frames in report.get('detections', {}).get('histogram', {}).items():
+                self._detections[int(count)] = self._detections.get(int(count), 0) + frames
+    
+    def report(self, frames: int) -> dict:
+        wall_seconds = time.perf_counter() - self._start
+        with self._lock:
+            stages = {
+                name: {
+                    'seconds': round(seconds, 4),
+                    'calls': calls,
+                    'ms_per_frame': round(seconds * 1000 / frames, 3) if frames else None
+                }
+                for name, (seconds, calls) in sorted(self._stages.items())
+            }
+            histogram = dict(sorted(self._detections.items()))
+        
+        counted = sum(histogram.values())
+        total = sum(count * frames_with for count, frames_with in histogram.items())
+        return {
+            'frames': frames,
+            'wall_seconds': round(wall_seconds, 3),
+            'fps': round(frames / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+            'stages': stages,
+            'detections': {
+                'total': total,
+                'per_frame_mean': round(total / counted, 3) if counted else 0.0,
+                'per_frame_max': max(histogram, default=0),
+                'histogram': {str(count): frames_with for count, frames_with in histogram.items()}
+            },
+            'peak_rss_mb': peak_rss_mb()
+        }
+
+
+_segment_progress_queue = None
+_segment_cancel_event = None
+
+
+def _init_segment_worker(progress_queue, cancel_event, threads: int):
+    global _segment_progress_queue, _segment_cancel_event
+    _segment_progress_queue = progress_queue
+    _segment_cancel_event = cancel_event
+    
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def _process_segment(index: int, input_path: str, output_path: str, blurrer_kwargs: dict) -> Tuple[bool, str, int, Optional[dict]]:
+    def progress_callback(progress, fps, message):
+        _segment_progress_queue.put((index, progress, fps))
+        if _segment_cancel_event.is_set():
+            blurrer.cancel()
+    
+    blurrer = VideoBlurrer(progress_callback=progress_callback, **blurrer_kwargs)
+    success, message = blurrer.process_video(input_path, output_path)
+    return success, message, blurrer.frames_processed, blurrer.performance_report
+
+
+def _pitch_shift_block(block: np.ndarray, sample_rate: int, semitones: float) -> np.ndarray:
+    import librosa
+    # soundfile blocks are (frames, channels) while librosa wants channels first
+    return librosa.effects.pitch_shift(block.T, sr=sample_rate, n_steps=semitones).T
+
+
+def shift_pitch_streaming(
+    input_path: str,
+    output_path: str,
+    semitones: float,
+    block_seconds: float = 10.0,
+    crossfade_seconds: float = 0.1,
+    workers: int = 1
+):
+    """Pitch-shift an audio file block by block, so memory stays flat for any duration.
+    
+    Consecutive blocks overlap by crossfade_seconds and are crossfaded to
+    hide the seams. With workers > 1 blocks are shifted in a process pool
+    with a bounded number of blocks in flight.
+    """
+    import soundfile as sf
+    
+    with sf.SoundFile(input_path) as source:
+        sample_rate = source.samplerate
+        channels = source.channels
+    
+    overlap = max(1, int(crossfade_seconds * sample_rate))
+    block_size = max(overlap + 1, int(block_seconds * sample_rate))
+    fade_in = np.linspace(0.0, 1.0, overlap, dtype=np.float32)[:, None]
+    fade_out = 1.0 - fade_in
+    blocks = sf.blocks(
+        input_path,
+        blocksize=block_size + overlap,
+        overlap=overlap,
+        dtype='float32',
+        always_2d=True
+    )
+    
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    
+    def shifted_blocks():
+        if executor is None:
+            for block in blocks:
+                yield _pitch_shift_block(block, sample_rate, semitones)
+            return
+        pending = deque()
+        for block in blocks:
+            pending.append(executor.submit(_pitch_shift_block, block, sample_rate, semitones))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    
+    try:
+        with sf.SoundFile(output_path, 'w', samplerate=sample_rate, channels=channels, subtype='PCM_16') as sink:
+            tail = None
+            for shifted in shifted_blocks():
+                shifted = np.array(shifted, dtype=np.float32)
+                if tail is not None:
+                    count = min(len(tail), len(shifted))
+                    shifted[:count] = tail[:count] * fade_out[:count] + shifted[:count] * fade_in[:count]
+                # The end of each block is held back to crossfade with the next one
+                keep = max(0, len(shifted) - overlap)
+                sink.write(np.clip(shifted[:keep], -1.0, 1.0))
+                tail = shifted[keep:]
+            if tail is not None:
+                sink.write(np.clip(tail, -1.0, 1.0))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
 class VideoBlurrer:
     
     def __init__(
@@ -40,8 +866,40 @@ class VideoBlurrer:
         detect_faces: bool = True,
         detect_license_plates: bool = True,
         progress_callback=None,
-        pitch_shift: float = 0.0
+        pitch_shift: float = 0.0,
+        batch_size: int = 1,
+        pipeline: bool = False,
+        pipeline_queue_size: int = 4,
+        detection_interval: int = 1,
+        scene_cut_threshold: float = 0.25,
+        tracking_margin: float = 0.15,
+        model_cache: Optional[ModelCache] = None,
+        detection_max_side: Optional[int] = None,
+        encoder: str = "opencv",
+        video_codec: str = "libx264",
+        encoder_preset: Optional[str] = "medium",
+        crf: Optional[int] = 23,
+        decoder: str = "opencv",
+        keep_audio: bool = True,
+        segments: int = 1,
+        detection_cache_dir: Optional[str] = None,
+        composite_blur: bool = False,
+        inference_service: Optional[InferenceService] = None,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_interval: int = 1500,
+        output_format: str = "mp4",
+        segment_duration: float = 4.0,
+        audio_workers: int = 1,
+        profile: bool = False,
+        stage_observer=None,
+        input_stall_timeout: float = 120.0
     ):
+        self._init_kwargs = {
+            name: value for name, value in locals().items()
+            if name not in (
+                'self', 'progress_callback', 'model_cache', 'inference_service', 'checkpoint_dir', 'stage_observer'
+            )
+        }
         self.blur_strength = blur_strength if blur_strength % 2 == 1 else blur_strength + 1
         self.blur_type = blur_type
         self.confidence = confidence
@@ -49,8 +907,42 @@ class VideoBlurrer:
         self.detect_license_plates = detect_license_plates
         self.progress_callback = progress_callback
         self.pitch_shift = pitch_shift
+        self.batch_size = max(1, int(batch_size))
+        self.pipeline = pipeline
+        self.pipeline_queue_size = max(1, int(pipeline_queue_size))
+        self.detection_interval = max(1, int(detection_interval))
+        self.scene_cut_threshold = scene_cut_threshold
+        self.tracking_margin = tracking_margin
+        self.detection_max_side = detection_max_side
+        self.encoder = encoder
+        self.video_codec = video_codec
+        self.encoder_preset = encoder_preset
+        self.crf = crf
+        self.decoder = decoder
+        self.keep_audio = keep_audio
+        self.segments = max(1, int(segments))
+        self.detection_cache_dir = detection_cache_dir
+        self.composite_blur_enabled = composite_blur
+        self.inference_service = inference_service
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = max(1, int(checkpoint_interval))
+        self.output_format = output_format
+        self.segment_duration = segment_duration
+        self.audio_workers = max(1, int(audio_workers))
+        self.input_stall_timeout = input_stall_timeout
+        self._run_finished = threading.Event()
+        self.profile = profile
+        self.stage_observer = stage_observer
+        self.profiler = None
+        self.performance_report = None
+        self.frames_processed = 0
+        self._frame_index = 0
+        self._cached_detections = None
+        self._recorded_detections = None
         self.face_padding = 0.2
+        self.license_plate_padding = 0.1
         self.is_cancelled = False
+        self.reset_tracking()
         
         if device == "auto":
             import torch
@@ -62,42 +954,48 @@ class VideoBlurrer:
                 device = "cpu"
         
         self.device = device
+        self.model_cache = model_cache
         self.models = []
         self.face_detector = None
+        self.face_detector_lock = threading.Lock()
+        self.model_weights = []
+        model_roles = {}
         
         if detect_faces:
             if MEDIAPIPE_AVAILABLE:
-                if MEDIAPIPE_NEW_API:
-                    self.face_detector = mp_face_detection.FaceDetection(
-                        model_selection=1,
-                        min_detection_confidence=self.confidence
-                    )
-                else:
-                    self.mp_face_detection = mp.solutions.face_detection
-                    self.face_detector = self.mp_face_detection.FaceDetection(
-                        model_selection=1,
-                        min_detection_confidence=self.confidence
-                    )
+                self.face_detector, self.face_detector_lock = self._borrow_model(
+                    ("mediapipe", "face_detection", self.confidence),
+                    lambda: _create_face_detector(self.confidence)
+                )
             else:
-                if face_model_path:
-                    face_model = YOLO(face_model_path)
-                else:
-                    face_model = YOLO("yolo11n.pt")
-                face_model.to(device)
-                self.models.append(("face", face_model))
+                model_roles.setdefault(face_model_path or "yolo11n.pt", []).append("face")
         
         if detect_license_plates:
-            if license_plate_model_path:
-                lp_model = YOLO(license_plate_model_path)
-            else:
-                lp_model = YOLO("yolo11n.pt")
-            lp_model.to(device)
-            self.models.append(("license_plate", lp_model))
+            model_roles.setdefault(license_plate_model_path or "yolo11n.pt", []).append("license_plate")
+        
+        for weights, roles in model_roles.items():
+            model, lock = self._borrow_model(
+                ("yolo", weights, device),
+                lambda weights=weights: _load_yolo(weights, device)
+            )
+            self.models.append((tuple(roles), model, lock))
+            self.model_weights.append(weights)
+    
+    def _borrow_model(self, key: tuple, loader):
+        if self.model_cache is None:
+            return loader(), threading.Lock()
+        return self.model_cache.get(key, loader)
     
     def cancel(self):
         self.is_cancelled = True
     
-    def blur_region(self, frame: np.ndarray, bbox: Tuple[int, int, int, int], padding: float = 0.0) -> np.ndarray:
+    def _stage(self, name: str):
+        profiler = self.profiler
+        if profiler is None:
+            return nullcontext()
+        return profiler.stage(name)
+    
+    def _padded_box(self, frame_shape: Tuple[int, ...], bbox: Tuple[int, int, int, int], padding: float) -> Tuple[int, int, int, int]:
         x1, y1, x2, y2 = bbox
         
         if padding > 0:
@@ -105,73 +1003,346 @@ class VideoBlurrer:
             height = y2 - y1
             pad_x = int(width * padding)
             pad_y = int(height * padding)
-            x1 = max(0, x1 - pad_x)
-            y1 = max(0, y1 - pad_y)
-            x2 = min(frame.shape[1], x2 + pad_x)
-            y2 = min(frame.shape[0], y2 + pad_y)
+            x1 = x1 - pad_x
+            y1 = y1 - pad_y
+            x2 = x2 + pad_x
+            y2 = y2 + pad_y
         
         x1, y1 = max(0, x1), max(0, y1)
-        x2, y2 = min(frame.shape[1], x2), min(frame.shape[0], y2)
-        
-        if x2 <= x1 or y2 <= y1:
-            return frame
+        x2, y2 = min(frame_shape[1], x2), min(frame_shape[0], y2)
+        return x1, y1, x2, y2
+    
+    def _blur_sigma(self) -> float:
+        return 0.3 * ((self.blur_strength - 1) * 0.5 - 1) + 0.8
+    
+    def _fast_gaussian_blur(self, roi: np.ndarray) -> np.ndarray:
+        sigma = self._blur_sigma()
+        factor = max(1, int(sigma // 2))
+        h, w = roi.shape[:2]
+        if factor == 1 or min(h, w) < 2 * factor:
+            return cv2.GaussianBlur(roi, (self.blur_strength, self.blur_strength), 0)
         
-        roi = frame[y1:y2, x1:x2]
+        small = cv2.resize(roi, (w // factor, h // factor), interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (0, 0), sigma / factor)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    
+    def _box_blur(self, roi: np.ndarray, passes: int = 3) -> np.ndarray:
+        sigma = self._blur_sigma()
+        size = int(round(np.sqrt(12 * sigma * sigma / passes + 1)))
+        size = max(3, size if size % 2 == 1 else size + 1)
         
+        blurred = roi
+        for _ in range(passes):
+            blurred = cv2.blur(blurred, (size, size))
+        return blurred
+    
+    def _mosaic_blur(self, roi: np.ndarray) -> np.ndarray:
+        block = max(2, self.blur_strength // 5)
+        h, w = roi.shape[:2]
+        small = cv2.resize(roi, (max(1, w // block), max(1, h // block)), interpolation=cv2.INTER_AREA)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+    
+    def _blur_roi(self, roi: np.ndarray) -> np.ndarray:
         if self.blur_type == "gaussian":
-            blurred_roi = cv2.GaussianBlur(roi, (self.blur_strength, self.blur_strength), 0)
+            return cv2.GaussianBlur(roi, (self.blur_strength, self.blur_strength), 0)
         elif self.blur_type == "pixelate":
             h, w = roi.shape[:2]
             small = cv2.resize(roi, (max(1, w // 10), max(1, h // 10)), interpolation=cv2.INTER_LINEAR)
-            blurred_roi = cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+            return cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+        elif self.blur_type == "fast_gaussian":
+            return self._fast_gaussian_blur(roi)
+        elif self.blur_type == "box":
+            return self._box_blur(roi)
+        elif self.blur_type == "mosaic":
+            return self._mosaic_blur(roi)
         else:
-            blurred_roi = cv2.GaussianBlur(roi, (self.blur_strength, self.blur_strength), 0)
+            return cv2.GaussianBlur(roi, (self.blur_strength, self.blur_strength), 0)
+    
+    def blur_region(self, frame: np.ndarray, bbox: Tuple[int, int, int, int], padding: float = 0.0) -> np.ndarray:
+        x1, y1, x2, y2 = self._padded_box(frame.shape, bbox, padding)
         
-        frame[y1:y2, x1:x2] = blurred_roi
+        if x2 <= x1 or y2 <= y1:
+            return frame
+        
+        frame[y1:y2, x1:x2] = self._blur_roi(frame[y1:y2, x1:x2])
         return frame
     
-    def process_frame(self, frame: np.ndarray) -> np.ndarray:
-        if self.detect_faces and self.face_detector is not None:
+    def _group_boxes(self, boxes: List[Tuple[int, int, int, int]]) -> List[Tuple[Tuple[int, int, int, int], List[Tuple[int, int, int, int]]]]:
+        groups = [(box, [box]) for box in boxes]
+        
+        merged = True
+        while merged and len(groups) > 1:
+            merged = False
+            for i in range(len(groups)):
+                for j in range(i + 1, len(groups)):
+                    (ax1, ay1, ax2, ay2), a_members = groups[i]
+                    (bx1, by1, bx2, by2), b_members = groups[j]
+                    union = (min(ax1, bx1), min(ay1, by1), max(ax2, bx2), max(ay2, by2))
+                    union_area = (union[2] - union[0]) * (union[3] - union[1])
+                    separate_area = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1)
+                    # Intersecting boxes always share one pass so no pixel is blurred twice;
+                    # disjoint neighbours only when the union is no larger than both apart
+                    intersects = ax1 < bx2 and bx1 < ax2 and ay1 < by2 and by1 < ay2
+                    if intersects or union_area <= separate_area:
+                        groups[i] = (union, a_members + b_members)
+                        del groups[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        
+        return groups
+    
+    def composite_blur(self, frame: np.ndarray, boxes: List[Tuple[int, int, int, int]]) -> np.ndarray:
+        boxes = [(x1, y1, x2, y2) for x1, y1, x2, y2 in boxes if x2 > x1 and y2 > y1]
+        
+        for (gx1, gy1, gx2, gy2), members in self._group_boxes(boxes):
+            roi = frame[gy1:gy2, gx1:gx2]
+            blurred = self._blur_roi(roi)
+            
+            if len(members) == 1:
+                roi[...] = blurred
+                continue
+            
+            mask = np.zeros(roi.shape[:2], dtype=bool)
+            for x1, y1, x2, y2 in members:
+                mask[y1 - gy1:y2 - gy1, x1 - gx1:x2 - gx1] = True
+            np.copyto(roi, blurred, where=mask[..., None])
+        
+        return frame
+    
+    def _detection_frame(self, frame: np.ndarray) -> Tuple[np.ndarray, Tuple[float, float]]:
+        h, w = frame.shape[:2]
+        if not self.detection_max_side or max(h, w) <= self.detection_max_side:
+            return frame, (1.0, 1.0)
+        
+        scale = self.detection_max_side / max(h, w)
+        small_w = max(1, int(round(w * scale)))
+        small_h = max(1, int(round(h * scale)))
+        small = cv2.resize(frame, (small_w, small_h), interpolation=cv2.INTER_AREA)
+        return small, (w / small_w, h / small_h)
+    
+    def _detect_mediapipe_faces(self, frame: np.ndarray, full_size: Tuple[int, int]) -> List[Detection]:
+        detections = []
+        with self._stage('color_convert'):
             rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        with self.face_detector_lock, self._stage('mediapipe'):
             results = self.face_detector.process(rgb_frame)
-            
-            if results.detections:
+        
+        if results.detections:
+            w, h = full_size
+            for detection in results.detections:
+                bbox = detection.location_data.relative_bounding_box
+                x1 = int(bbox.xmin * w)
+                y1 = int(bbox.ymin * h)
+                x2 = int((bbox.xmin + bbox.width) * w)
+                y2 = int((bbox.ymin + bbox.height) * h)
+                
+                x1 = max(0, x1)
+                y1 = max(0, y1)
+                x2 = min(w, x2)
+                y2 = min(h, y2)
+                
+                if x2 > x1 and y2 > y1:
+                    detections.append(((x1, y1, x2, y2), DETECTION_FACE))
+        
+        return detections
+    
+    def _detection_padding(self, flags: int) -> float:
+        padding = 0.0
+        if flags & DETECTION_FACE:
+            padding = max(padding, self.face_padding)
+        if flags & DETECTION_LICENSE_PLATE:
+            padding = max(padding, self.license_plate_padding)
+        if flags & DETECTION_TRACKED:
+            padding += self.tracking_margin
+        return padding
+    
+    def _model_detections(
+        self,
+        model_types: Tuple[str, ...],
+        result,
+        scale: Tuple[float, float] = (1.0, 1.0),
+        min_confidence: Optional[float] = None
+    ) -> List[Detection]:
+        detections = []
+        boxes = result.boxes
+        if len(boxes) == 0:
+            return detections
+        
+        flags = 0
+        for model_type in model_types:
+            flags |= ROLE_FLAGS.get(model_type, 0)
+        scale_x, scale_y = scale
+        
+        for box in boxes:
+            if min_confidence is not None and float(box.conf[0]) < min_confidence:
+                continue
+            xyxy = box.xyxy[0].cpu().numpy()
+            if scale == (1.0, 1.0):
+                x1, y1, x2, y2 = xyxy.astype(int)
+            else:
+                x1 = int(np.floor(xyxy[0] * scale_x))
+                y1 = int(np.floor(xyxy[1] * scale_y))
+                x2 = int(np.ceil(xyxy[2] * scale_x))
+                y2 = int(np.ceil(xyxy[3] * scale_y))
+            detections.append(((x1, y1, x2, y2), flags))
+        
+        return detections
+    
+    def detect_batch(self, frames: List[np.ndarray]) -> List[List[Detection]]:
+        detections = [[] for _ in frames]
+        if not frames:
+            return detections
+        
+        with self._stage('resize'):
+            scaled = [self._detection_frame(frame) for frame in frames]
+        detect_frames = [small for small, _ in scaled]
+        scales = [scale for _, scale in scaled]
+        
+        if self.detect_faces and self.face_detector is not None:
+            for frame_detections, frame, detect_frame in zip(detections, frames, detect_frames):
                 h, w = frame.shape[:2]
-                for detection in results.detections:
-                    bbox = detection.location_data.relative_bounding_box
-                    x1 = int(bbox.xmin * w)
-                    y1 = int(bbox.ymin * h)
-                    x2 = int((bbox.xmin + bbox.width) * w)
-                    y2 = int((bbox.ymin + bbox.height) * h)
-                    
-                    x1 = max(0, x1)
-                    y1 = max(0, y1)
-                    x2 = min(w, x2)
-                    y2 = min(h, y2)
-                    
-                    if x2 > x1 and y2 > y1:
-                        self.blur_region(frame, (x1, y1, x2, y2), padding=self.face_padding)
+                frame_detections.extend(self._detect_mediapipe_faces(detect_frame, (w, h)))
         
-        for model_type, model in self.models:
-            results = model(frame, conf=self.confidence, iou=0.5, verbose=False)
+        for (model_types, model, lock), weights in zip(self.models, self.model_weights):
+            stage = f"yolo:{os.path.basename(weights)}"
+            if self.inference_service is not None:
+                # Includes the wait for a shared batch; the service reports the forward pass itself
+                with self._stage(stage):
+                    results = self.inference_service.infer(
+                        model, lock, detect_frames, self.confidence, name=stage, client=id(self)
+                    )
+                min_confidence = self.confidence
+            else:
+                with lock, self._stage(stage):
+                    results = model(detect_frames, conf=self.confidence, iou=0.5, verbose=False)
+                min_confidence = None
             
-            for result in results:
-                boxes = result.boxes
-                if len(boxes) == 0:
-                    continue
-                    
-                for box in boxes:
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-                    cls = int(box.cls[0].cpu().numpy())
-                    
-                    if model_type == "face":
-                        self.blur_region(frame, (x1, y1, x2, y2), padding=self.face_padding)
-                    
-                    elif model_type == "license_plate":
-                        self.blur_region(frame, (x1, y1, x2, y2), padding=0.1)
+            for frame_detections, result, scale in zip(detections, results, scales):
+                frame_detections.extend(self._model_detections(model_types, result, scale, min_confidence))
         
+        return detections
+    
+    def blur_detections(self, frame: np.ndarray, detections: List[Detection]) -> np.ndarray:
+        if self.composite_blur_enabled:
+            boxes = [self._padded_box(frame.shape, bbox, self._detection_padding(flags)) for bbox, flags in detections]
+            return self.composite_blur(frame, boxes)
+        
+        for bbox, flags in detections:
+            self.blur_region(frame, bbox, padding=self._detection_padding(flags))
         return frame
     
+    def reset_tracking(self):
+        self._prev_gray = None
+        self._prev_thumbnail = None
+        self._tracked_detections = []
+        self._frames_since_keyframe = 0
+    
+    def _is_scene_cut(self, thumbnail: np.ndarray) -> bool:
+        if self._prev_thumbnail is None or thumbnail.shape != self._prev_thumbnail.shape:
+            return True
+        difference = float(np.mean(cv2.absdiff(thumbnail, self._prev_thumbnail))) / 255.0
+        return difference > self.scene_cut_threshold
+    
+    def _track_detections(
+        self,
+        prev_gray: np.ndarray,
+        gray: np.ndarray,
+        detections: List[Detection]
+    ) -> List[Detection]:
+        h, w = gray.shape[:2]
+        tracked = []
+        
+        for (x1, y1, x2, y2), flags in detections:
+            points = cv2.goodFeaturesToTrack(
+                prev_gray[y1:y2, x1:x2],
+                maxCorners=20,
+                qualityLevel=0.01,
+                minDistance=3
+            )
+            
+            if points is not None:
+                points = points.reshape(-1, 2) + np.array([x1, y1], dtype=np.float32)
+                new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                    prev_gray, gray, points.reshape(-1, 1, 2), None
+                )
+                found = status.reshape(-1) == 1
+                if found.any():
+                    dx, dy = np.median(new_points.reshape(-1, 2)[found] - points[found], axis=0)
+                    dx, dy = int(round(dx)), int(round(dy))
+                    box_w, box_h = x2 - x1, y2 - y1
+                    x1 = min(max(0, x1 + dx), w - 1)
+                    y1 = min(max(0, y1 + dy), h - 1)
+                    x2 = min(w, x1 + box_w)
+                    y2 = min(h, y1 + box_h)
+            
+            if x2 > x1 and y2 > y1:
+                tracked.append(((x1, y1, x2, y2), flags))
+        
+        return tracked
+    
+    def _detect_with_tracking(self, frames: List[np.ndarray]) -> List[List[Detection]]:
+        with self._stage('color_convert'):
+            grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+        
+        keyframes = []
+        frames_since_keyframe = self._frames_since_keyframe
+        for gray in grays:
+            thumbnail = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+            is_keyframe = frames_since_keyframe >= self.detection_interval or self._is_scene_cut(thumbnail)
+            if is_keyframe:
+                frames_since_keyframe = 0
+            keyframes.append(is_keyframe)
+            frames_since_keyframe += 1
+            self._prev_thumbnail = thumbnail
+        
+        keyframe_detections = iter(self.detect_batch([frame for frame, key in zip(frames, keyframes) if key]))
+        
+        detections = []
+        for gray, is_keyframe in zip(grays, keyframes):
+            if is_keyframe:
+                self._tracked_detections = next(keyframe_detections)
+                detections.append(self._tracked_detections)
+            else:
+                with self._stage('tracking'):
+                    self._tracked_detections = self._track_detections(self._prev_gray, gray, self._tracked_detections)
+                detections.append([(bbox, flags | DETECTION_TRACKED) for bbox, flags in self._tracked_detections])
+            self._prev_gray = gray
+        
+        self._frames_since_keyframe = frames_since_keyframe
+        return detections
+    
+    def process_batch(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        if not frames:
+            return frames
+        
+        start = self._frame_index
+        self._frame_index += len(frames)
+        
+        cached = self._cached_detections
+        if cached is not None and start + len(frames) <= len(cached):
+            detections = cached[start:start + len(frames)]
+        elif self.detection_interval > 1:
+            detections = self._detect_with_tracking(frames)
+        else:
+            detections = self.detect_batch(frames)
+        
+        if self._recorded_detections is not None:
+            self._recorded_detections.extend(detections)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.count_detections(len(frame_detections) for frame_detections in detections)
+        
+        with self._stage('blur'):
+            for frame, frame_detections in zip(frames, detections):
+                self.blur_detections(frame, frame_detections)
+        
+        return frames
+    
+    def process_frame(self, frame: np.ndarray) -> np.ndarray:
+        return self.process_batch([frame])[0]
+    
     def _check_ffmpeg(self) -> bool:
         try:
             subprocess.run(['ffmpeg', '-version'], 
@@ -182,14 +1353,99 @@ class VideoBlurrer:
         except (subprocess.CalledProcessError, FileNotFoundError):
             return False
     
+    def _ffmpeg_has_filter(self, name: str) -> bool:
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-filters'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            )
+        except FileNotFoundError:
+            return False
+        return any(line.split()[1:2] == [name] for line in result.stdout.splitlines())
+    
+    def _pitch_filter(self, input_video: str, semitones: float) -> str:
+        pitch_ratio = 2 ** (semitones / 12.0)
+        if self._ffmpeg_has_filter('rubberband'):
+            return f'rubberband=pitch={pitch_ratio}'
+        
+        sample_rate = int(_ffprobe_stream(input_video, 'a:0', 'sample_rate').get('sample_rate', 44100))
+        return f'asetrate={sample_rate * pitch_ratio},aresample={sample_rate},atempo={1 / pitch_ratio}'
+    
+    def _wait_for_input(
+        self,
+        input_path: str,
+        input_complete: threading.Event,
+        stop: Optional[threading.Event] = None
+    ) -> bool:
+        """Wait for input_complete; False if cancelled, stopped or input_path stopped growing first"""
+        size = None
+        last_growth = time.time()
+        while not input_complete.wait(0.5):
+            if self.is_cancelled or (stop is not None and stop.is_set()):
+                return False
+            current = os.path.getsize(input_path) if os.path.exists(input_path) else 0
+            if current != size:
+                size = current
+                last_growth = time.time()
+            elif time.time() - last_growth > self.input_stall_timeout:
+                return False
+        return True
+    
+    def _open_reader(self, input_path: str, input_complete: Optional[threading.Event] = None):
+        if input_complete is not None:
+            info = video_info(input_path)
+            if not info:
+                return None, None
+            return FFmpegReader(
+                input_path, info['width'], info['height'],
+                input_complete=input_complete, stall_timeout=self.input_stall_timeout
+            ), info
+        
+        if self.decoder == "ffmpeg" and self._check_ffmpeg():
+            info = probe_video(input_path)
+            if info:
+                return FFmpegReader(input_path, info['width'], info['height']), info
+        
+        cap = cv2.VideoCapture(input_path)
+        if not cap.isOpened():
+            return None, None
+        
+        info = {
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': cap.get(cv2.CAP_PROP_FPS),
+            'frame_count': int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        }
+        return cap, info
+    
+    def _open_writer(self, input_path: str, output_path: str, fps: float, width: int, height: int, with_audio: bool = True):
+        with_audio = with_audio and self.keep_audio
+        # Progressive formats need the ffmpeg muxer whichever encoder was chosen
+        if (self.encoder == "ffmpeg" or self.output_format != "mp4") and self._check_ffmpeg():
+            audio_filter = None
+            if with_audio and abs(self.pitch_shift) > 0.01:
+                audio_filter = self._pitch_filter(input_path, self.pitch_shift)
+            writer = FFmpegWriter(
+                output_path, fps, width, height,
+                audio_source=input_path if with_audio else None,
+                audio_filter=audio_filter,
+                codec=self.video_codec,
+                preset=self.encoder_preset,
+                crf=self.crf,
+                output_format=self.output_format,
+                segment_duration=self.segment_duration,
+                audio_codec=self._audio_codec(input_path, output_path) if with_audio else "aac"
+            )
+            return writer, with_audio
+        
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        return cv2.VideoWriter(output_path, fourcc, fps, (width, height)), False
+    
     def _shift_audio_pitch(self, input_audio_path: str, output_audio_path: str, semitones: float) -> bool:
         try:
-            import librosa
-            import soundfile as sf
-            
-            y, sr = librosa.load(input_audio_path, sr=None)
-            y_shifted = librosa.effects.pitch_shift(y, sr=sr, n_steps=semitones)
-            sf.write(output_audio_path, y_shifted, sr)
+            shift_pitch_streaming(input_audio_path, output_audio_path, semitones, workers=self.audio_workers)
             return True
         except ImportError:
             return self._shift_audio_pitch_ffmpeg(input_audio_path, output_audio_path, semitones)
@@ -238,137 +1494,852 @@ class VideoBlurrer:
         except Exception:
             return False
     
-    def _merge_audio(self, input_video: str, output_video: str, pitch_shift: float = 0.0) -> Optional[str]:
-        if not self._check_ffmpeg():
+    def _audio_codec(self, input_path: str, output_path: str) -> str:
+        """'copy' when the unshifted source audio fits the output container, else 'aac'"""
+        if abs(self.pitch_shift) > 0.01:
+            return 'aac'
+        extension = os.path.splitext(output_path)[1].lower()
+        if extension not in AUDIO_COPY_CODECS:
+            return 'aac'
+        codec = _ffprobe_stream(input_path, 'a:0', 'codec_name').get('codec_name')
+        allowed = AUDIO_COPY_CODECS[extension]
+        if codec and (allowed is None or codec in allowed):
+            return 'copy'
+        return 'aac'
+    
+    def _prepare_audio(
+        self,
+        input_path: str,
+        audio_path: str,
+        input_complete: Optional[threading.Event] = None,
+        use_filter: bool = False
+    ) -> Optional[str]:
+        """Write the pitch-shifted audio of input_path to audio_path as AAC.
+        
+        Meant to run in the background while video is processed. Returns
+        None when the input has no audio or shifting failed.
+        """
+        # Gives up with the run, e.g. when reading the growing input failed
+        if input_complete is not None and not self._wait_for_input(input_path, input_complete, self._run_finished):
             return None
         
-        output_path = Path(output_video)
-        temp_audio = str(output_path.parent / f"{output_path.stem}_temp_audio.wav")
-        final_output = str(output_path.parent / f"{output_path.stem}_with_audio{output_path.suffix}")
+        if use_filter:
+            cmd = [
+                'ffmpeg',
+                '-loglevel', 'error',
+                '-i', input_path,
+                '-map', '0:a:0',
+                '-af', self._pitch_filter(input_path, self.pitch_shift),
+                '-c:a', 'aac',
+                '-y',
+                audio_path
+            ]
+            with self._stage('pitch_shift'):
+                result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            return audio_path if result.returncode == 0 else None
         
+        stem = os.path.splitext(audio_path)[0]
+        extracted_audio = f"{stem}_extracted.wav"
+        shifted_audio = f"{stem}_shifted.wav"
         try:
             extract_cmd = [
                 'ffmpeg',
-                '-i', input_video,
-                '-vn', '-acodec', 'pcm_s16le',
+                '-loglevel', 'error',
+                '-i', input_path,
+                '-map', '0:a:0',
+                '-acodec', 'pcm_s16le',
                 '-y',
-                temp_audio
+                extracted_audio
             ]
-            
-            result = subprocess.run(
-                extract_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
+            with self._stage('audio_extract'):
+                result = subprocess.run(extract_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
             if result.returncode != 0:
-                os.replace(output_video, final_output)
-                return final_output
+                return None
             
-            if abs(pitch_shift) > 0.01:
-                shifted_audio = str(output_path.parent / f"{output_path.stem}_shifted_audio.wav")
-                if self._shift_audio_pitch(temp_audio, shifted_audio, pitch_shift):
-                    temp_audio = shifted_audio
-                if os.path.exists(str(output_path.parent / f"{output_path.stem}_temp_audio.wav")):
-                    os.remove(str(output_path.parent / f"{output_path.stem}_temp_audio.wav"))
+            source = extracted_audio
+            with self._stage('pitch_shift'):
+                shifted = self._shift_audio_pitch(extracted_audio, shifted_audio, self.pitch_shift)
+            if shifted:
+                source = shifted_audio
             
+            encode_cmd = ['ffmpeg', '-loglevel', 'error', '-i', source, '-c:a', 'aac', '-y', audio_path]
+            with self._stage('audio_encode'):
+                result = subprocess.run(encode_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            return audio_path if result.returncode == 0 else None
+        except Exception as e:
+            print(f"Error preparing audio: {e}")
+            return None
+        finally:
+            for path in (extracted_audio, shifted_audio):
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    def _start_audio_preparation(
+        self,
+        input_path: str,
+        audio_path: str,
+        input_complete: Optional[threading.Event] = None,
+        use_filter: bool = False
+    ) -> Optional[Future]:
+        if not self.keep_audio or abs(self.pitch_shift) <= 0.01 or not self._check_ffmpeg():
+            return None
+        
+        future = Future()
+        
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._prepare_audio(input_path, audio_path, input_complete, use_filter))
+            except Exception as e:
+                future.set_exception(e)
+        
+        threading.Thread(target=run, daemon=True).start()
+        return future
+    
+    @staticmethod
+    def _prepared_audio(future: Optional[Future]) -> Optional[str]:
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Error preparing audio: {e}")
+            return None
+    
+    @staticmethod
+    def _discard_prepared_audio(future: Optional[Future]):
+        def remove(done: Future):
+            if not done.exception() and done.result() and os.path.exists(done.result()):
+                os.remove(done.result())
+        
+        if future is not None:
+            future.add_done_callback(remove)
+    
+    def _merge_audio(self, input_video: str, output_video: str, prepared_audio: Optional[str] = None) -> Optional[str]:
+        if not self._check_ffmpeg():
+            return None
+        # Without the shifted track the output stays silent rather than carrying the original voice
+        if not prepared_audio and abs(self.pitch_shift) > 0.01:
+            return None
+        
+        output_path = Path(output_video)
+        final_output = str(output_path.parent / f"{output_path.stem}_with_audio{output_path.suffix}")
+        
+        if prepared_audio:
+            audio_args = ['-i', prepared_audio, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'copy']
+        else:
+            audio_args = [
+                '-i', input_video,
+                '-map', '0:v:0',
+                '-map', '1:a:0?',
+                '-c:a', self._audio_codec(input_video, output_video)
+            ]
+        
+        try:
             merge_cmd = [
                 'ffmpeg',
-                '-i', output_video,
-                '-i', temp_audio,
+                '-loglevel', 'error',
+                '-i', output_video
+            ] + audio_args + [
                 '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-map', '0:v:0',
-                '-map', '1:a:0',
                 '-shortest',
                 '-y',
                 final_output
             ]
             
-            result = subprocess.run(
-                merge_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            if os.path.exists(temp_audio):
-                os.remove(temp_audio)
+            with self._stage('mux'):
+                result = subprocess.run(
+                    merge_cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True
+                )
             
             if result.returncode == 0:
                 os.replace(final_output, output_video)
                 return output_video
             else:
+                if os.path.exists(final_output):
+                    os.remove(final_output)
                 return None
                 
         except Exception as e:
             print(f"Error merging audio: {e}")
             return None
+        finally:
+            if prepared_audio and os.path.exists(prepared_audio):
+                os.remove(prepared_audio)
+    
+    def _read_batch(self, cap, limit: Optional[int] = None) -> List[np.ndarray]:
+        batch = []
+        with self._stage('decode'):
+            while len(batch) < (limit or self.batch_size):
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                batch.append(frame)
+        return batch
+    
+    def _report_frame_progress(self, frame_count: int, total_frames: int, start_time: float):
+        if self.progress_callback and frame_count % 5 == 0:
+            elapsed = time.time() - start_time
+            fps_actual = frame_count / elapsed if elapsed > 0 else 0
+            progress = min(100, (frame_count / total_frames) * 100) if total_frames > 0 else 0
+            self.progress_callback(progress, fps_actual, f"Processing frame {frame_count}/{total_frames}")
+    
+    def _run_sequential(
+        self,
+        cap,
+        out,
+        total_frames: int,
+        start_time: float,
+        max_frames: Optional[int] = None,
+        frame_offset: int = 0
+    ) -> Optional[int]:
+        frame_count = 0
+        recycle = getattr(cap, 'recycle', None)
+        
+        while max_frames is None or frame_count < max_frames:
+            if self.is_cancelled:
+                return None
+            
+            limit = self.batch_size if max_frames is None else min(self.batch_size, max_frames - frame_count)
+            batch = self._read_batch(cap, limit)
+            if not batch:
+                break
+            
+            for processed_frame in self.process_batch(batch):
+                with self._stage('encode'):
+                    out.write(processed_frame)
+                if recycle:
+                    recycle(processed_frame)
+                frame_count += 1
+                self._report_frame_progress(frame_offset + frame_count, total_frames, start_time)
+        
+        return frame_count
+    
+    def _run_pipelined(
+        self,
+        cap,
+        out,
+        total_frames: int,
+        start_time: float,
+        max_frames: Optional[int] = None,
+        frame_offset: int = 0
+    ) -> Optional[int]:
+        decode_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        encode_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        stop = threading.Event()
+        end_of_stream = object()
+        errors = []
+        frame_count = 0
+        recycle = getattr(cap, 'recycle', None)
+        
+        def put(q, item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return end_of_stream
+        
+        def decode():
+            read = 0
+            # Stops exactly at max_frames, so the next part continues from the right frame
+            while not stop.is_set() and (max_frames is None or read < max_frames):
+                limit = None if max_frames is None else min(self.batch_size, max_frames - read)
+                batch = self._read_batch(cap, limit)
+                if not batch:
+                    break
+                read += len(batch)
+                if not put(decode_queue, batch):
+                    return
+            put(decode_queue, end_of_stream)
+        
+        def detect():
+            while True:
+                batch = get(decode_queue)
+                if batch is end_of_stream:
+                    break
+                if not put(encode_queue, self.process_batch(batch)):
+                    return
+            put(encode_queue, end_of_stream)
+        
+        def encode():
+            nonlocal frame_count
+            while True:
+                batch = get(encode_queue)
+                if batch is end_of_stream:
+                    break
+                for processed_frame in batch:
+                    with self._stage('encode'):
+                        out.write(processed_frame)
+                    if recycle:
+                        recycle(processed_frame)
+                    frame_count += 1
+                    self._report_frame_progress(frame_offset + frame_count, total_frames, start_time)
+        
+        def run_stage(stage):
+            try:
+                stage()
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+        
+        threads = [
+            threading.Thread(target=run_stage, args=(stage,), daemon=True)
+            for stage in (decode, detect, encode)
+        ]
+        for thread in threads:
+            thread.start()
+        
+        encoder = threads[-1]
+        while encoder.is_alive():
+            if self.is_cancelled:
+                stop.set()
+            encoder.join(timeout=0.1)
+        
+        stop.set()
+        for thread in threads:
+            thread.join()
+        
+        if errors:
+            raise errors[0]
+        if self.is_cancelled:
+            return None
+        return frame_count
+    
+    def _split_segments(self, input_path: str, work_dir: str, count: int, duration: float) -> List[str]:
+        cmd = [
+            'ffmpeg',
+            '-loglevel', 'error',
+            '-i', input_path,
+            '-map', '0:v:0',
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_time', f'{duration / count:.3f}',
+            '-reset_timestamps', '1',
+            '-y',
+            os.path.join(work_dir, 'segment_%03d.mkv')
+        ]
+        with self._stage('split'):
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            return []
+        return sorted(
+            os.path.join(work_dir, name) for name in os.listdir(work_dir)
+            if name.startswith('segment_') and name.endswith('.mkv')
+        )
+    
+    def _concat_segments(
+        self,
+        input_path: str,
+        parts: List[str],
+        output_path: str,
+        work_dir: str,
+        prepared_audio: Optional[str] = None
+    ) -> Tuple[bool, str]:
+        list_path = os.path.join(work_dir, 'parts.txt')
+        with open(list_path, 'w') as f:
+            for part in parts:
+                escaped = os.path.abspath(part).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        
+        cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if self.keep_audio and prepared_audio:
+            cmd += ['-i', prepared_audio, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'copy', '-shortest']
+        elif self.keep_audio:
+            cmd += ['-i', input_path, '-map', '0:v:0', '-map', '1:a:0?']
+            if abs(self.pitch_shift) > 0.01:
+                cmd += ['-af', self._pitch_filter(input_path, self.pitch_shift)]
+            cmd += ['-c:a', self._audio_codec(input_path, output_path), '-shortest']
+        cmd += ['-c:v', 'copy', '-y', output_path]
+        
+        with self._stage('mux'):
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        return result.returncode == 0, result.stderr.strip()
+    
+    def _process_video_segmented(self, input_path: str, output_path: str) -> Optional[Tuple[bool, str]]:
+        info = video_info(input_path)
+        if not info or info['fps'] <= 0 or info['frame_count'] <= 0:
+            return None
+        
+        if self.checkpoint_dir:
+            work_dir = self.checkpoint_dir
+            os.makedirs(work_dir, exist_ok=True)
+        else:
+            output_dir = os.path.dirname(os.path.abspath(output_path))
+            work_dir = tempfile.mkdtemp(prefix='.defaceit_segments_', dir=output_dir)
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        discard_work_dir = not self.checkpoint_dir
+        audio_future = self._start_audio_preparation(input_path, os.path.join(work_dir, 'audio.m4a'), use_filter=True)
+        try:
+            manifest = self._load_checkpoint(manifest_path, input_path) if self.checkpoint_dir else {}
+            segments = [os.path.join(work_dir, name) for name in manifest.get('segments', [])]
+            
+            if not segments or not all(os.path.exists(segment) for segment in segments):
+                if self.progress_callback:
+                    self.progress_callback(0, 0, "Splitting video into segments...")
+                
+                duration = info['frame_count'] / info['fps']
+                segments = self._split_segments(input_path, work_dir, self.segments, duration)
+                if not segments:
+                    discard_work_dir = True
+                    return None
+                manifest = {
+                    'input_size': os.path.getsize(input_path),
+                    'segments': [os.path.basename(segment) for segment in segments],
+                    'done': {}
+                }
+                if self.checkpoint_dir:
+                    self._save_checkpoint(manifest_path, manifest)
+            
+            parts = [os.path.join(work_dir, f'part_{index:03d}.mp4') for index in range(len(segments))]
+            done = {
+                int(index): frames for index, frames in manifest['done'].items()
+                if os.path.exists(parts[int(index)])
+            }
+            
+            weights = []
+            for segment in segments:
+                segment_info = probe_video(segment)
+                weights.append(segment_info['frame_count'] if segment_info and segment_info['frame_count'] > 0 else 1)
+            total_weight = float(sum(weights))
+            
+            blurrer_kwargs = dict(
+                self._init_kwargs,
+                device=self.device,
+                keep_audio=False,
+                segments=1,
+                profile=self.profile
+            )
+            remaining = [index for index in range(len(segments)) if index not in done]
+            threads = max(1, (os.cpu_count() or 1) // max(1, len(remaining)))
+            
+            context = multiprocessing.get_context('spawn')
+            progress_queue = context.Queue()
+            cancel_event = context.Event()
+            progress = [100.0 if index in done else 0.0 for index in range(len(segments))]
+            speeds = [0.0] * len(segments)
+            failures = []
+            processed = 0
+            start_time = time.time()
+            
+            if remaining:
+                with ProcessPoolExecutor(
+                    max_workers=len(remaining),
+                    mp_context=context,
+                    initializer=_init_segment_worker,
+                    initargs=(progress_queue, cancel_event, threads)
+                ) as executor:
+                    pending = {
+                        executor.submit(_process_segment, index, segments[index], parts[index], blurrer_kwargs): index
+                        for index in remaining
+                    }
+                    
+                    while pending:
+                        if self.is_cancelled:
+                            cancel_event.set()
+                        
+                        for future in [future for future in pending if future.done()]:
+                            index = pending.pop(future)
+                            success, message, frames, report = future.result()
+                            if not success:
+                                failures.append(message)
+                                continue
+                            if report and self.profiler is not None:
+                                self.profiler.merge(report)
+                            done[index] = frames
+                            processed += frames
+                            speeds[index] = 0.0
+                            if self.checkpoint_dir:
+                                manifest['done'] = {str(i): f for i, f in done.items()}
+                                self._save_checkpoint(manifest_path, manifest)
+                        
+                        try:
+                            index, segment_progress, fps = progress_queue.get(timeout=0.2)
+                        except queue.Empty:
+                            continue
+                        if index in done:
+                            continue
+                        progress[index] = segment_progress
+                        speeds[index] = fps
+                        if self.progress_callback:
+                            overall = sum(p * w for p, w in zip(progress, weights)) / total_weight
+                            self.progress_callback(
+                                overall * 0.9, sum(speeds),
+                                f"Processing {len(segments)} segments in parallel..."
+                            )
+            
+            if self.is_cancelled:
+                discard_work_dir = True
+                return False, "Processing cancelled"
+            if failures:
+                return False, failures[0]
+            
+            self.frames_processed = processed
+            elapsed = time.time() - start_time
+            fps_actual = self.frames_processed / elapsed if elapsed > 0 else 0
+            
+            if self.progress_callback:
+                self.progress_callback(95, fps_actual, "Joining segments...")
+            
+            success, error = self._concat_segments(
+                input_path, parts, output_path, work_dir,
+                prepared_audio=self._prepared_audio(audio_future)
+            )
+            if not success:
+                return False, f"Joining segments failed: {error}"
+            
+            discard_work_dir = True
+            if self.progress_callback:
+                self.progress_callback(100, fps_actual, "Complete!")
+            
+            return True, f"Processing complete! Speed: {fps_actual:.2f} FPS"
+        finally:
+            if discard_work_dir:
+                self._prepared_audio(audio_future)
+                shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _load_checkpoint(self, manifest_path: str, input_path: str) -> dict:
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('input_size') != os.path.getsize(input_path):
+            return {}
+        return manifest
+    
+    def _save_checkpoint(self, manifest_path: str, manifest: dict):
+        temp_path = f"{manifest_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, manifest_path)
     
-    def process_video(self, input_path: str, output_path: str) -> Tuple[bool, str]:
+    def _process_video_checkpointed(
+        self,
+        input_path: str,
+        output_path: str,
+        cap,
+        info: dict,
+        detection_cache_path: Optional[str]
+    ) -> Tuple[bool, str]:
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        manifest_path = os.path.join(self.checkpoint_dir, 'manifest.json')
+        manifest = self._load_checkpoint(manifest_path, input_path)
+        parts = manifest.get('parts', [])
+        if not all(os.path.exists(os.path.join(self.checkpoint_dir, part)) for part in parts):
+            manifest = {}
+        if not manifest:
+            manifest = {'input_size': os.path.getsize(input_path), 'parts': [], 'frames': 0}
+        
+        fps = info['fps']
+        width = info['width']
+        height = info['height']
+        total_frames = info['frame_count']
+        resumed_frames = manifest['frames']
+        frame_count = resumed_frames
+        audio_future = self._start_audio_preparation(
+            input_path, os.path.join(self.checkpoint_dir, 'audio.m4a'), use_filter=True
+        )
+        
+        if self.inference_service is not None:
+            for _, model, lock in self.models:
+                self.inference_service.attach(model, lock)
+        
+        try:
+            if resumed_frames:
+                if self.progress_callback:
+                    self.progress_callback(0, 0, f"Resuming from frame {resumed_frames}/{total_frames}...")
+                with self._stage('decode'):
+                    for _ in range(resumed_frames):
+                        if not cap.grab():
+                            break
+                # Detections of the skipped frames are not available to record
+                self._recorded_detections = None
+                self._frame_index = resumed_frames
+            
+            start_time = time.time()
+            run = self._run_pipelined if self.pipeline else self._run_sequential
+            
+            while True:
+                part_name = f"part_{len(manifest['parts']):04d}.mp4"
+                part_path = os.path.join(self.checkpoint_dir, part_name)
+                out, _ = self._open_writer(input_path, part_path, fps, width, height, with_audio=False)
+                try:
+                    count = run(
+                        cap, out, total_frames, start_time,
+                        max_frames=self.checkpoint_interval,
+                        frame_offset=frame_count
+                    )
+                finally:
+                    with self._stage('encode'):
+                        out.release()
+                
+                if count is None:
+                    self._prepared_audio(audio_future)
+                    shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+                    return False, "Processing cancelled"
+                if isinstance(out, FFmpegWriter) and out.error:
+                    return False, f"Encoding failed: {out.error}"
+                if count == 0:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    break
+                
+                frame_count += count
+                manifest['parts'].append(part_name)
+                manifest['frames'] = frame_count
+                self._save_checkpoint(manifest_path, manifest)
+                
+                if count < self.checkpoint_interval:
+                    break
+        finally:
+            cap.release()
+            if self.inference_service is not None:
+                for _, model, lock in self.models:
+                    self.inference_service.detach(model, lock, client=id(self))
+        
+        if not manifest['parts']:
+            return False, f"No frames could be read from: {input_path}"
+        
+        self.frames_processed = frame_count - resumed_frames
+        elapsed = time.time() - start_time
+        fps_actual = self.frames_processed / elapsed if elapsed > 0 else 0
+        
+        if detection_cache_path and self._recorded_detections is not None:
+            save_detections(detection_cache_path, self._recorded_detections)
+        self._recorded_detections = None
+        
+        if self.progress_callback:
+            self.progress_callback(95, fps_actual, "Joining segments...")
+        
+        parts = [os.path.join(self.checkpoint_dir, part) for part in manifest['parts']]
+        success, error = self._concat_segments(
+            input_path, parts, output_path, self.checkpoint_dir,
+            prepared_audio=self._prepared_audio(audio_future)
+        )
+        if not success:
+            return False, f"Joining segments failed: {error}"
+        
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        
+        if self.progress_callback:
+            self.progress_callback(100, fps_actual, "Complete!")
+        
+        return True, f"Processing complete! Speed: {fps_actual:.2f} FPS"
+    
+    def _detection_cache_key(self, input_path: str) -> str:
+        models = []
+        for (roles, _, _), weights in zip(self.models, self.model_weights):
+            size = os.path.getsize(weights) if os.path.exists(weights) else None
+            models.append([list(roles), weights, size])
+        
+        identity = {
+            'video': file_digest(input_path),
+            'mediapipe': self.face_detector is not None,
+            'models': models,
+            'confidence': self.confidence,
+            'detection_max_side': self.detection_max_side,
+            'detection_interval': self.detection_interval,
+            'scene_cut_threshold': self.scene_cut_threshold
+        }
+        return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+    
+    def _prepare_detection_cache(self, input_path: str) -> Optional[str]:
+        self._cached_detections = None
+        self._recorded_detections = None
+        if not self.detection_cache_dir:
+            return None
+        
+        os.makedirs(self.detection_cache_dir, exist_ok=True)
+        cache_path = os.path.join(self.detection_cache_dir, f"{self._detection_cache_key(input_path)}.npz")
+        if os.path.exists(cache_path):
+            self._cached_detections = load_detections(cache_path)
+            if self._cached_detections is not None:
+                # Marks the sidecar as recently used for retention cleanup
+                os.utime(cache_path)
+        if self._cached_detections is None:
+            self._recorded_detections = []
+        return cache_path
+    
+    def process_video(
+        self,
+        input_path: str,
+        output_path: str,
+        input_complete: Optional[threading.Event] = None
+    ) -> Tuple[bool, str]:
+        """Blur input_path into output_path.
+        
+        input_complete marks input_path as still being written: decoding
+        follows the file and finishes once the event is set. The file must
+        be in a container that can be decoded front to back.
+        
+        With a progressive output_format the output is written in a single
+        pass so it can be served while processing; segments and checkpoints
+        are not used.
+        
+        With profile enabled, performance_report holds the per-stage timings,
+        detection counts and peak memory of the run afterwards. A
+        stage_observer is called with (stage, seconds) as stages complete;
+        segment workers do not report to it.
+        """
+        self.performance_report = None
+        self._run_finished.clear()
+        if self.profile or self.stage_observer is not None:
+            self.profiler = StageProfiler(self.stage_observer)
+        try:
+            return self._process_video(input_path, output_path, input_complete)
+        finally:
+            self._run_finished.set()
+            if self.profile:
+                self.performance_report = self.profiler.report(self.frames_processed)
+            self.profiler = None
+    
+    def _process_video(
+        self,
+        input_path: str,
+        output_path: str,
+        input_complete: Optional[threading.Event] = None
+    ) -> Tuple[bool, str]:
         self.is_cancelled = False
+        self.reset_tracking()
+        self.frames_processed = 0
+        
+        progressive = self.output_format != "mp4"
+        if self.output_format == "hls" and not self._check_ffmpeg():
+            return False, "HLS output requires ffmpeg"
+        
+        # Progressive output is read while it is written, so audio cannot be
+        # merged in afterwards: HLS, and fragmented MP4 with audio, need the
+        # whole input up front for the encoder to mux it
+        if input_complete is not None and not input_complete.is_set() and (
+            not self._check_ffmpeg()
+            or self.output_format == "hls"
+            or (self.output_format == "fragmented_mp4" and self.keep_audio)
+        ):
+            if self.progress_callback:
+                self.progress_callback(0, 0, "Waiting for upload to finish...")
+            if not self._wait_for_input(input_path, input_complete):
+                if self.is_cancelled:
+                    return False, "Processing cancelled"
+                return False, f"Input stopped growing for {self.input_stall_timeout:.0f}s before it was complete"
+        growing = input_complete is not None and not input_complete.is_set()
+        
+        # Splitting, checkpoints and the detection cache all need the whole file
+        if not growing and not progressive and self.segments > 1 and self._check_ffmpeg():
+            result = self._process_video_segmented(input_path, output_path)
+            if result is not None:
+                return result
         
         if self.progress_callback:
             self.progress_callback(0, 0, "Opening video...")
         
-        cap = cv2.VideoCapture(input_path)
+        cap, info = self._open_reader(input_path, input_complete if growing else None)
         
-        if not cap.isOpened():
+        if cap is None:
             return False, f"Could not open video: {input_path}"
         
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self._frame_index = 0
+        detection_cache_path = None
+        if not growing:
+            detection_cache_path = self._prepare_detection_cache(input_path)
+            if self._cached_detections is not None and self.progress_callback:
+                self.progress_callback(0, 0, "Reusing cached detections...")
+            
+            if self.checkpoint_dir and not progressive and self._check_ffmpeg():
+                return self._process_video_checkpointed(input_path, output_path, cap, info, detection_cache_path)
         
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        fps = info['fps']
+        width = info['width']
+        height = info['height']
+        total_frames = info['frame_count']
+        
+        # Audio of a growing input can only be muxed once the whole file is there
+        out, audio_muxed = self._open_writer(input_path, output_path, fps, width, height, with_audio=not growing)
+        
+        # Pitch-shifted audio that is not muxed by the encoder is prepared alongside the video
+        audio_future = None
+        if not audio_muxed:
+            audio_future = self._start_audio_preparation(
+                input_path,
+                str(Path(output_path).parent / f"{Path(output_path).stem}_audio.m4a"),
+                input_complete if growing else None
+            )
         
-        frame_count = 0
-        processed_count = 0
         start_time = time.time()
         
         if self.progress_callback:
             self.progress_callback(0, 0, f"Processing {total_frames} frames...")
         
-        while True:
-            if self.is_cancelled:
-                cap.release()
+        if self.inference_service is not None:
+            for _, model, lock in self.models:
+                self.inference_service.attach(model, lock)
+        
+        try:
+            if self.pipeline:
+                processed_count = self._run_pipelined(cap, out, total_frames, start_time)
+            else:
+                processed_count = self._run_sequential(cap, out, total_frames, start_time)
+        except BaseException:
+            self._discard_prepared_audio(audio_future)
+            raise
+        finally:
+            cap.release()
+            with self._stage('encode'):
                 out.release()
-                if os.path.exists(output_path):
-                    os.remove(output_path)
-                return False, "Processing cancelled"
-            
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            processed_frame = self.process_frame(frame.copy())
-            out.write(processed_frame)
-            
-            processed_count += 1
-            frame_count += 1
-            
-            if self.progress_callback and frame_count % 5 == 0:
-                elapsed = time.time() - start_time
-                fps_actual = processed_count / elapsed if elapsed > 0 else 0
-                progress = (frame_count / total_frames) * 100
-                self.progress_callback(progress, fps_actual, f"Processing frame {frame_count}/{total_frames}")
+            if self.inference_service is not None:
+                for _, model, lock in self.models:
+                    self.inference_service.detach(model, lock, client=id(self))
+        
+        if processed_count is None:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            if self.output_format == "hls":
+                stem = Path(output_path).stem
+                for segment in Path(output_path).parent.glob(f"{stem}_*.ts"):
+                    segment.unlink()
+            self._discard_prepared_audio(audio_future)
+            return False, "Processing cancelled"
+        
+        if getattr(cap, 'error', None):
+            self._discard_prepared_audio(audio_future)
+            return False, f"Reading input failed: {cap.error}"
         
-        cap.release()
-        out.release()
+        if isinstance(out, FFmpegWriter) and out.error:
+            self._discard_prepared_audio(audio_future)
+            return False, f"Encoding failed: {out.error}"
         
+        self.frames_processed = processed_count
         elapsed = time.time() - start_time
         
-        if self.progress_callback:
-            self.progress_callback(95, processed_count / elapsed if elapsed > 0 else 0, "Merging audio...")
+        if detection_cache_path and self._recorded_detections is not None:
+            save_detections(detection_cache_path, self._recorded_detections)
+        self._recorded_detections = None
         
-        audio_result = self._merge_audio(input_path, output_path, self.pitch_shift)
+        if audio_muxed or not self.keep_audio:
+            audio_result = output_path
+        else:
+            if self.progress_callback:
+                self.progress_callback(95, processed_count / elapsed if elapsed > 0 else 0, "Merging audio...")
+            
+            audio_result = self._merge_audio(input_path, output_path, self._prepared_audio(audio_future))
         
         if self.progress_callback:
             if audio_result:
                 self.progress_callback(100, processed_count / elapsed if elapsed > 0 else 0, "Complete!")
+            elif self._check_ffmpeg():
+                self.progress_callback(100, processed_count / elapsed if elapsed > 0 else 0, "Complete! (no audio - preparing audio failed)")
             else:
                 self.progress_callback(100, processed_count / elapsed if elapsed > 0 else 0, "Complete! (no audio - ffmpeg not found)")
         
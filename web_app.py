@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import json
+import shutil
+import struct
+import hashlib
 import uuid
 from pathlib import Path
-from flask import Flask, render_template, request, send_file, jsonify, url_for
+from flask import (
+    Flask, Response, render_template, request, send_file, send_from_directory, jsonify, url_for, stream_with_context
+)
 from werkzeug.utils import secure_filename
 import threading
 import time
 
-from video_blur_core import VideoBlurrer
+from video_blur_core import VideoBlurrer, shared_model_cache, shared_inference_service, video_info, file_digest
+from job_store import JobStore
+from metrics import MetricsRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
 app.config['UPLOAD_FOLDER'] = '/app/uploads'
 app.config['OUTPUT_FOLDER'] = '/app/outputs'
+app.config['DETECTION_CACHE_FOLDER'] = '/app/detections'
+app.config['CHECKPOINT_FOLDER'] = '/app/data/checkpoints'
+app.config['JOB_DATABASE'] = os.environ.get('DEFACEIT_JOB_DB', '/app/data/jobs.db')
 
 # Secret key for session management
 # WARNING: Set SECRET_KEY environment variable in production!
@@ -28,24 +40,306 @@ app.config['SECRET_KEY'] = secret_key
 
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'flv', 'wmv'}
 
-# Store job statuses in memory
-# NOTE: This is lost on restart. For production, consider Redis or database
-jobs = {}
+# 'fragmented_mp4' and 'hls' outputs can be streamed while the job is still running
+OUTPUT_FORMATS = ('mp4', 'fragmented_mp4', 'hls')
+DEFAULT_OUTPUT_FORMAT = os.environ.get('DEFACEIT_OUTPUT_FORMAT', 'mp4')
+
+VIDEO_ENCODER = os.environ.get('DEFACEIT_ENCODER', 'ffmpeg')
+VIDEO_CRF = int(os.environ.get('DEFACEIT_CRF', 23))
+
+# Encode jobs in checkpointed parts so a restarted server resumes them where
+# they stopped; costs an extra pass joining the parts into the output
+CHECKPOINT_JOBS = os.environ.get('DEFACEIT_CHECKPOINTS', '0').lower() in ('1', 'true', 'yes')
+
+# Per-stage timings, detection counts and peak memory in the job status
+PROFILE_JOBS = os.environ.get('DEFACEIT_PROFILE', '0').lower() in ('1', 'true', 'yes')
+
+# Storage: files of finished jobs and unused detection sidecars are removed
+# after RETENTION_HOURS, and the least recently used jobs earlier while all
+# stored data exceeds MAX_STORAGE_MB (0 disables the limit)
+RETENTION_SECONDS = float(os.environ.get('DEFACEIT_RETENTION_HOURS', 24)) * 3600
+MAX_STORAGE_BYTES = int(float(os.environ.get('DEFACEIT_MAX_STORAGE_MB', 0)) * 1024 * 1024)
+CLEANUP_INTERVAL_SECONDS = 300
+
+# Concurrency limits: jobs run on a fixed pool of worker threads and uploads
+# beyond the queue limit are rejected instead of piling up
+MAX_WORKERS = max(1, int(os.environ.get('DEFACEIT_WORKERS', 2)))
+MAX_QUEUED_JOBS = max(0, int(os.environ.get('DEFACEIT_MAX_QUEUED_JOBS', 16)))
+
+# Scheduling: 'sjf' runs the cheapest queued video (frames x pixels) first,
+# with waiting time discounting the cost so long videos are not starved;
+# 'fifo' runs jobs in arrival order
+SCHEDULER_POLICY = os.environ.get('DEFACEIT_SCHEDULER', 'sjf')
+SCHEDULER_AGING_SECONDS = float(os.environ.get('DEFACEIT_SCHEDULER_AGING_SECONDS', 60))
+SCHEDULER_MAX_WAIT_SECONDS = float(os.environ.get('DEFACEIT_SCHEDULER_MAX_WAIT_SECONDS', 600))
+
+# Chunked uploads: suggested chunk size, how much of a streamable upload
+# has to arrive before processing may start on it, and how long a job
+# started early waits for the next chunk before it fails
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+EARLY_START_BYTES = int(os.environ.get('DEFACEIT_EARLY_START_BYTES', 4 * 1024 * 1024))
+UPLOAD_STALL_SECONDS = float(os.environ.get('DEFACEIT_UPLOAD_STALL_SECONDS', 120))
+# Rough pixel-frames per byte of compressed video (about 0.1 bits per pixel),
+# used to cost partial uploads whose frame count is not known yet
+PIXEL_FRAMES_PER_BYTE = 80
+
+# Server-Sent Events: minimum seconds between progress pushes per client and
+# how often an idle stream sends a keep-alive comment
+EVENTS_MIN_INTERVAL = float(os.environ.get('DEFACEIT_EVENTS_MIN_INTERVAL', 0.5))
+EVENTS_KEEPALIVE_SECONDS = 15.0
+
+# Metrics: disk usage is walked at most this often, however often /metrics is scraped
+DISK_USAGE_CACHE_SECONDS = float(os.environ.get('DEFACEIT_DISK_USAGE_CACHE_SECONDS', 30))
+
+# Job statuses are persisted to SQLite so queued and interrupted jobs
+# can be picked up again after a restart
+jobs = JobStore(app.config['JOB_DATABASE'])
+
+# Chunk writes are serialised per upload; uploads whose job already started
+# keep an event here that is set once the last chunk arrives
+upload_locks = {}
+upload_events = {}
+uploads_lock = threading.Lock()
+
+class JobExecutor:
+    """Runs jobs on a fixed number of worker threads with a bounded queue"""
+    
+    def __init__(self, max_workers, max_queued, policy='fifo', aging_seconds=60.0, max_wait_seconds=600.0):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.policy = policy
+        self.aging_seconds = aging_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.active = 0
+        self._pending = []
+        self._condition = threading.Condition()
+        self._started = False
+    
+    def _start(self):
+        # torch and OpenCV thread pools are process-wide, so split the cores
+        # between workers instead of letting every job claim all of them
+        threads = max(1, (os.cpu_count() or 1) // self.max_workers)
+        try:
+            import cv2
+            cv2.setNumThreads(threads)
+        except ImportError:
+            pass
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+        
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._worker, name=f'defaceit-worker-{index}')
+            worker.daemon = True
+            worker.start()
+        self._started = True
+    
+    def _is_full(self):
+        # Jobs that an idle worker picks up at once do not count as waiting,
+        # so max_queued=0 still admits work while a worker is free
+        idle = max(0, self.max_workers - self.active)
+        return len(self._pending) >= self.max_queued + idle
+    
+    def is_full(self):
+        with self._condition:
+            return self._is_full()
+    
+    def submit(self, job_id, fn, *args, cost=None, force=False):
+        """Queue a job; returns False when the queue is full unless forced"""
+        with self._condition:
+            if not force and self._is_full():
+                return False
+            if not self._started:
+                self._start()
+            self._pending.append((job_id, fn, args, cost, time.time()))
+            self._condition.notify()
+            return True
+    
+    def _priority(self, entry, now):
+        _, _, _, cost, enqueued_at = entry
+        waited = now - enqueued_at
+        if self.policy != 'sjf' or waited >= self.max_wait_seconds:
+            return (0, enqueued_at)
+        # Unknown cost (probe failed) is treated as cheap: such jobs usually fail fast
+        return (1, (cost or 0) / (1.0 + waited / self.aging_seconds), enqueued_at)
+    
+    def _ordered_pending(self):
+        now = time.time()
+        return sorted(self._pending, key=lambda entry: self._priority(entry, now))
+    
+    def position(self, job_id):
+        """1-based position of a queued job, or None if it is not waiting"""
+        with self._condition:
+            for index, entry in enumerate(self._ordered_pending()):
+                if entry[0] == job_id:
+                    return index + 1
+            return None
+    
+    def queue_depth(self):
+        with self._condition:
+            return len(self._pending)
+    
+    def _next_job(self):
+        entry = self._ordered_pending()[0]
+        self._pending.remove(entry)
+        return entry
+    
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                job_id, fn, args, _, _ = self._next_job()
+                self.active += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                # Keep the worker alive: a dead thread would still count as idle in _is_full
+                print(f"Job {job_id} failed outside its task: {e}")
+                self._mark_failed(job_id, e)
+            finally:
+                with self._condition:
+                    self.active -= 1
+    
+    def _mark_failed(self, job_id, error):
+        try:
+            job = jobs.get(job_id)
+            if job and job['status'] not in ('completed', 'failed', 'expired'):
+                jobs.update(job_id, status='failed', error=str(error), finished_at=time.time())
+        except Exception as e:
+            print(f"Could not mark job {job_id} as failed: {e}")
+
+executor = JobExecutor(
+    MAX_WORKERS,
+    MAX_QUEUED_JOBS,
+    policy=SCHEDULER_POLICY,
+    aging_seconds=SCHEDULER_AGING_SECONDS,
+    max_wait_seconds=SCHEDULER_MAX_WAIT_SECONDS
+)
+
+# Current speed of running jobs, summed for the processing FPS gauge
+running_fps = {}
+disk_usage_cache = {'checked_at': 0.0, 'usage': {}}
+disk_usage_lock = threading.Lock()
+
+def disk_usage():
+    """Bytes used per storage folder, recomputed at most every DISK_USAGE_CACHE_SECONDS"""
+    with disk_usage_lock:
+        if time.time() - disk_usage_cache['checked_at'] >= DISK_USAGE_CACHE_SECONDS:
+            disk_usage_cache['usage'] = {
+                ('uploads',): folder_size(app.config['UPLOAD_FOLDER']),
+                ('outputs',): folder_size(app.config['OUTPUT_FOLDER']),
+                ('checkpoints',): folder_size(app.config['CHECKPOINT_FOLDER']),
+                ('detections',): folder_size(app.config['DETECTION_CACHE_FOLDER'])
+            }
+            disk_usage_cache['checked_at'] = time.time()
+        return disk_usage_cache['usage']
+
+metrics = MetricsRegistry()
+metrics.gauge('defaceit_queue_depth', 'Jobs waiting for a worker', callback=executor.queue_depth)
+metrics.gauge('defaceit_active_jobs', 'Jobs being processed', callback=lambda: executor.active)
+metrics.gauge(
+    'defaceit_processing_fps', 'Frames per second summed over running jobs',
+    callback=lambda: round(sum(running_fps.values()), 2)
+)
+metrics.gauge('defaceit_disk_usage_bytes', 'Bytes stored per folder', ['folder'], callback=disk_usage)
+job_duration_metric = metrics.histogram(
+    'defaceit_job_duration_seconds', 'Processing time of finished jobs', ['status'],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+frames_processed_metric = metrics.counter('defaceit_frames_processed_total', 'Frames processed by finished jobs')
+inference_latency_metric = metrics.histogram(
+    'defaceit_inference_seconds', 'Detector forward pass time per batch, excluding queueing', ['detector'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+upload_bytes_metric = metrics.counter('defaceit_upload_bytes_total', 'Bytes received in uploads')
+output_bytes_metric = metrics.counter('defaceit_output_bytes_total', 'Bytes of processed video written')
+
+def observe_stage(stage, seconds):
+    """Feed MediaPipe timings from VideoBlurrer into the inference latency histogram"""
+    # YOLO stages include the wait for a shared batch, so those come from the inference service
+    if stage == 'mediapipe':
+        inference_latency_metric.observe(seconds, detector=stage)
+
+def observe_inference(name, seconds, frames):
+    inference_latency_metric.observe(seconds, detector=name or 'yolo')
+
+shared_inference_service.observer = observe_inference
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_video_task(job_id, input_path, output_path, settings):
+def is_streamable(path, file_ext):
+    """Whether a partial upload can be decoded front to back; None while unknown"""
+    if file_ext in ('mkv', 'flv'):
+        return True
+    if file_ext not in ('mp4', 'mov'):
+        return False
+    
+    # MP4/MOV needs its index (moov) before the media data (mdat), i.e. faststart
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, box = struct.unpack('>I4s', header)
+            if box == b'moov':
+                return True
+            if box == b'mdat':
+                return False
+            if size == 1:
+                large = f.read(8)
+                if len(large) < 8:
+                    return None
+                size = struct.unpack('>Q', large)[0] - 8
+            if size < 8:
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+def parse_settings(form):
+    """Processing settings from the upload form"""
+    output_format = form.get('output_format', DEFAULT_OUTPUT_FORMAT)
+    return {
+        'blur_strength': int(form.get('blur_strength', 51)),
+        'confidence': float(form.get('confidence', 0.15)),
+        'blur_type': form.get('blur_type', 'gaussian'),
+        'detect_faces': form.get('detect_faces', 'true').lower() == 'true',
+        'detect_license_plates': form.get('detect_license_plates', 'true').lower() == 'true',
+        'device': form.get('device', 'auto'),
+        'pitch_shift': float(form.get('pitch_shift', 0.0)),
+        'output_format': output_format if output_format in OUTPUT_FORMATS else 'mp4'
+    }
+
+def job_paths(job_id, filename, output_format='mp4'):
+    """Input and output paths for a job; HLS output is a playlist in its own folder"""
+    file_ext = filename.rsplit('.', 1)[1].lower()
+    input_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}_input.{file_ext}")
+    if output_format == 'hls':
+        output_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{job_id}_hls", 'playlist.m3u8')
+    elif output_format == 'fragmented_mp4':
+        output_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{job_id}_output.mp4")
+    else:
+        output_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{job_id}_output.{file_ext}")
+    return input_path, output_path
+
+def process_video_task(job_id, input_path, output_path, settings, input_complete=None):
     """Background task to process video"""
+    started_at = time.time()
+    blurrer = None
     try:
-        jobs[job_id]['status'] = 'processing'
-        jobs[job_id]['progress'] = 0
+        jobs.update(job_id, status='processing')
         
         def progress_callback(progress, fps, message):
             """Progress callback receives 3 parameters from VideoBlurrer"""
-            jobs[job_id]['progress'] = int(progress)
-            jobs[job_id]['message'] = message
-            jobs[job_id]['fps'] = round(fps, 2) if fps > 0 else 0
+            running_fps[job_id] = fps
+            jobs.update(
+                job_id,
+                progress=int(progress),
+                message=message,
+                fps=round(fps, 2) if fps > 0 else 0
+            )
         
         blurrer = VideoBlurrer(
             device=settings.get('device', 'auto'),
@@ -55,23 +349,211 @@ def process_video_task(job_id, input_path, output_path, settings):
             detect_faces=settings.get('detect_faces', True),
             detect_license_plates=settings.get('detect_license_plates', True),
             progress_callback=progress_callback,
-            pitch_shift=settings.get('pitch_shift', 0.0)
+            pitch_shift=settings.get('pitch_shift', 0.0),
+            model_cache=shared_model_cache,
+            encoder=VIDEO_ENCODER,
+            crf=VIDEO_CRF,
+            detection_cache_dir=app.config['DETECTION_CACHE_FOLDER'],
+            inference_service=shared_inference_service,
+            checkpoint_dir=job_checkpoint_dir(job_id) if CHECKPOINT_JOBS else None,
+            output_format=settings.get('output_format', 'mp4'),
+            profile=PROFILE_JOBS,
+            stage_observer=observe_stage,
+            input_stall_timeout=UPLOAD_STALL_SECONDS
         )
         
-        blurrer.process_video(input_path, output_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        success, message = blurrer.process_video(input_path, output_path, input_complete=input_complete)
         
-        jobs[job_id]['status'] = 'completed'
-        jobs[job_id]['progress'] = 100
-        jobs[job_id]['output_file'] = os.path.basename(output_path)
+        if success:
+            jobs.update(
+                job_id,
+                status='completed',
+                progress=100,
+                output_file=os.path.basename(output_path),
+                finished_at=time.time(),
+                performance=blurrer.performance_report
+            )
+        else:
+            jobs.update(
+                job_id,
+                status='failed',
+                error=message,
+                finished_at=time.time(),
+                performance=blurrer.performance_report
+            )
         
     except Exception as e:
-        jobs[job_id]['status'] = 'failed'
-        jobs[job_id]['error'] = str(e)
+        jobs.update(job_id, status='failed', error=str(e), finished_at=time.time())
+    finally:
+        running_fps.pop(job_id, None)
+        # A job that gave up on its upload no longer waits for the last chunk
+        upload_events.pop(job_id, None)
+        job = jobs.get(job_id)
+        job_duration_metric.observe(time.time() - started_at, status=job['status'] if job else 'failed')
+        if blurrer is not None:
+            frames_processed_metric.inc(blurrer.frames_processed)
+        if job and job['status'] == 'completed' and os.path.exists(job_output(job)):
+            output_bytes_metric.inc(path_size(job_output(job)))
+        if job and job['status'] == 'failed':
+            # A failed job is never resumed, so its encoded parts are of no further use
+            shutil.rmtree(job_checkpoint_dir(job_id), ignore_errors=True)
+
+def result_key(input_path, settings):
+    """Hash of the input content plus every setting that changes the output"""
+    normalized = {
+        'blur_strength': int(settings['blur_strength']),
+        'confidence': round(float(settings['confidence']), 3),
+        'blur_type': settings['blur_type'],
+        'detect_faces': bool(settings['detect_faces']),
+        'detect_license_plates': bool(settings['detect_license_plates']),
+        'pitch_shift': round(float(settings['pitch_shift']), 2),
+        'output_format': settings.get('output_format', 'mp4'),
+        'encoder': VIDEO_ENCODER,
+        'crf': VIDEO_CRF
+    }
+    payload = json.dumps({'input': file_digest(input_path), 'settings': normalized}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def find_duplicate(key):
+    """Job that already produced, or is producing, the result for key"""
+    for job_id, job in jobs.items():
+        if job.get('result_key') != key:
+            continue
+        if job['status'] in ('queued', 'processing'):
+            return job_id
+        if job['status'] == 'completed' and os.path.exists(job['output_path']):
+            return job_id
+    return None
+
+def find_job(job_id):
+    """(job_id, job) of the job doing the work, following duplicate submissions"""
+    job = jobs.get(job_id)
+    if job is not None and job.get('duplicate_of'):
+        return job['duplicate_of'], jobs.get(job['duplicate_of'])
+    return job_id, job
+
+def folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def path_size(path):
+    return folder_size(path) if os.path.isdir(path) else os.path.getsize(path)
+
+def job_output(job):
+    """Output of a job; HLS output is its whole folder"""
+    if job.get('settings', {}).get('output_format') == 'hls' and job.get('output_path'):
+        return os.path.dirname(job['output_path'])
+    return job.get('output_path')
+
+def job_checkpoint_dir(job_id):
+    return os.path.join(app.config['CHECKPOINT_FOLDER'], job_id)
+
+def job_files(job_id, job):
+    """Input, output and checkpoint files of a job that exist on disk"""
+    files = [job.get('input_path'), job_output(job), job_checkpoint_dir(job_id)]
+    return [path for path in files if path and os.path.exists(path)]
+
+def remove_job_files(job_id, job):
+    for path in job_files(job_id, job):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def cleanup_detection_cache(now):
+    """Remove detection sidecars that were not used within the retention period"""
+    folder = app.config['DETECTION_CACHE_FOLDER']
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        try:
+            # Reusing a sidecar refreshes its modification time
+            if entry.is_file() and now - entry.stat().st_mtime > RETENTION_SECONDS:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def cleanup_storage():
+    """Expire finished jobs past retention, then least recently used ones while over the storage limit"""
+    now = time.time()
+    cleanup_detection_cache(now)
+    candidates = []
+    for job_id, job in jobs.items():
+        last_used = job.get('last_accessed') or job.get('finished_at') or job.get('created_at', 0)
+        if job['status'] in ('completed', 'failed', 'uploading'):
+            candidates.append((last_used, job_id, job))
+        elif job['status'] in ('expired', 'duplicate') and now - last_used > 7 * RETENTION_SECONDS:
+            jobs.delete(job_id)
+    candidates.sort(key=lambda candidate: candidate[0])
+    
+    def expire(job_id, job):
+        remove_job_files(job_id, job)
+        jobs.update(job_id, status='expired')
+    
+    remaining = []
+    for last_used, job_id, job in candidates:
+        # Abandoned uploads count as idle since their last chunk
+        if now - last_used > RETENTION_SECONDS and job_id not in upload_events:
+            expire(job_id, job)
+        elif job['status'] != 'uploading':
+            remaining.append((job_id, job))
+    
+    if MAX_STORAGE_BYTES:
+        usage = sum(
+            folder_size(app.config[folder])
+            for folder in ('UPLOAD_FOLDER', 'OUTPUT_FOLDER', 'CHECKPOINT_FOLDER', 'DETECTION_CACHE_FOLDER')
+        )
+        for job_id, job in remaining:
+            if usage <= MAX_STORAGE_BYTES:
+                break
+            size = sum(path_size(path) for path in job_files(job_id, job))
+            expire(job_id, job)
+            usage -= size
+
+def storage_janitor():
+    while True:
+        try:
+            cleanup_storage()
+        except Exception as e:
+            print(f"Storage cleanup failed: {e}")
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+
+def resume_unfinished_jobs():
+    """Requeue jobs that were queued or running when the server stopped"""
+    for job_id, job in jobs.unfinished():
+        input_path = job.get('input_path')
+        if not input_path or not os.path.exists(input_path):
+            jobs.update(job_id, status='failed', error='Input file is no longer available')
+            continue
+        if os.path.getsize(input_path) < job.get('upload_size', 0):
+            # Started early on a partial upload: wait for the client to resume it
+            jobs.update(job_id, status='uploading')
+            continue
+        jobs.update(job_id, status='queued')
+        # Interrupted jobs were already admitted once, so they bypass the queue limit
+        executor.submit(
+            job_id, process_video_task, job_id, input_path, job['output_path'], job['settings'],
+            cost=job.get('estimated_cost'), force=True
+        )
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def busy_response():
+    response = jsonify({'error': 'Server is busy processing other videos. Please try again later.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '30'
+    return response
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'video' not in request.files:
@@ -84,6 +566,9 @@ def upload_file():
     if not allowed_file(file.filename):
         return jsonify({'error': f'Invalid file type. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
     
+    if executor.is_full():
+        return busy_response()
+    
     # Create upload and output directories if they don't exist
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
@@ -91,94 +576,363 @@ def upload_file():
     # Generate unique job ID
     job_id = str(uuid.uuid4())
     
+    # Get settings from form
+    settings = parse_settings(request.form)
+    
     # Save uploaded file
     filename = secure_filename(file.filename)
-    file_ext = filename.rsplit('.', 1)[1].lower()
-    input_filename = f"{job_id}_input.{file_ext}"
-    output_filename = f"{job_id}_output.{file_ext}"
-    
-    input_path = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
-    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    input_path, output_path = job_paths(job_id, filename, settings['output_format'])
     
     file.save(input_path)
+    upload_bytes_metric.inc(os.path.getsize(input_path))
     
-    # Get settings from form
-    settings = {
-        'blur_strength': int(request.form.get('blur_strength', 51)),
-        'confidence': float(request.form.get('confidence', 0.15)),
-        'blur_type': request.form.get('blur_type', 'gaussian'),
-        'detect_faces': request.form.get('detect_faces', 'true').lower() == 'true',
-        'detect_license_plates': request.form.get('detect_license_plates', 'true').lower() == 'true',
-        'device': request.form.get('device', 'auto'),
-        'pitch_shift': float(request.form.get('pitch_shift', 0.0))
-    }
+    # An identical upload with identical settings reuses the existing job
+    key = result_key(input_path, settings)
+    duplicate_id = find_duplicate(key)
+    if duplicate_id:
+        os.remove(input_path)
+        jobs.update(duplicate_id, last_accessed=time.time())
+        return jsonify({
+            'job_id': duplicate_id,
+            'duplicate': True,
+            'message': 'This video was already processed with the same settings.'
+        })
+    
+    # Probe the upload so the scheduler can estimate its cost in pixel-frames
+    info = video_info(input_path)
+    estimated_cost = info['frame_count'] * info['width'] * info['height'] if info else None
     
     # Initialize job status
-    jobs[job_id] = {
+    jobs.create(job_id, {
         'status': 'queued',
         'progress': 0,
         'input_file': filename,
-        'created_at': time.time()
-    }
+        'input_path': input_path,
+        'output_path': output_path,
+        'settings': settings,
+        'created_at': time.time(),
+        'estimated_cost': estimated_cost,
+        'result_key': key
+    })
     
-    # Start background processing
-    # Note: Using daemon threads for simplicity. For production, consider
-    # a task queue like Celery for better job management and graceful shutdown
-    thread = threading.Thread(
-        target=process_video_task,
-        args=(job_id, input_path, output_path, settings)
-    )
-    thread.daemon = True
-    thread.start()
+    # Queue background processing on the shared worker pool
+    if not executor.submit(job_id, process_video_task, job_id, input_path, output_path, settings, cost=estimated_cost):
+        jobs.delete(job_id)
+        os.remove(input_path)
+        return busy_response()
     
     return jsonify({
         'job_id': job_id,
         'message': 'Video upload successful. Processing started.'
     })
 
-@app.route('/status/<job_id>')
-def get_status(job_id):
-    if job_id not in jobs:
-        return jsonify({'error': 'Job not found'}), 404
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    """Start a chunked upload; chunks are then sent with PUT to upload_url"""
+    filename = secure_filename(request.form.get('filename', ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': f'Invalid file type. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+    
+    try:
+        size = int(request.form.get('size', 0))
+    except ValueError:
+        size = 0
+    if size <= 0:
+        return jsonify({'error': 'Invalid file size'}), 400
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'File is too large'}), 413
+    
+    if executor.is_full():
+        return busy_response()
+    
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+    
+    job_id = str(uuid.uuid4())
+    settings = parse_settings(request.form)
+    input_path, output_path = job_paths(job_id, filename, settings['output_format'])
+    open(input_path, 'wb').close()
+    
+    jobs.create(job_id, {
+        'status': 'uploading',
+        'progress': 0,
+        'input_file': filename,
+        'input_path': input_path,
+        'output_path': output_path,
+        'settings': settings,
+        'created_at': time.time(),
+        'estimated_cost': None,
+        'upload_size': size
+    })
+    
+    return jsonify({
+        'job_id': job_id,
+        'upload_url': url_for('upload_chunk', job_id=job_id),
+        'chunk_size': UPLOAD_CHUNK_SIZE
+    })
+
+@app.route('/uploads/<job_id>', methods=['GET'])
+def upload_offset(job_id):
+    """Bytes received so far, so an interrupted upload can resume"""
+    job = jobs.get(job_id)
+    if job is None or 'upload_size' not in job:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    received = os.path.getsize(job['input_path']) if os.path.exists(job['input_path']) else 0
+    return jsonify({'received': received, 'size': job['upload_size']})
+
+@app.route('/uploads/<job_id>', methods=['PUT'])
+def upload_chunk(job_id):
+    """Append one chunk, given by its Content-Range, straight to disk"""
+    job = jobs.get(job_id)
+    if job is None or 'upload_size' not in job:
+        return jsonify({'error': 'Upload not found'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job.get('error', 'Processing failed')}), 400
+    
+    match = re.match(r'bytes (\d+)-(\d+)/(\d+)$', request.headers.get('Content-Range', ''))
+    if not match:
+        return jsonify({'error': 'Missing or invalid Content-Range header'}), 400
+    start, end, total = (int(value) for value in match.groups())
+    if total != job['upload_size'] or end < start or end >= total:
+        return jsonify({'error': 'Invalid Content-Range header'}), 400
+    
+    with uploads_lock:
+        lock = upload_locks.setdefault(job_id, threading.Lock())
+    
+    with lock:
+        received = os.path.getsize(job['input_path']) if os.path.exists(job['input_path']) else 0
+        if start != received:
+            return jsonify({'error': 'Chunk does not start at the received offset', 'received': received}), 409
+        
+        with open(job['input_path'], 'ab') as f:
+            remaining = end - start + 1
+            while remaining > 0:
+                data = request.stream.read(min(1024 * 1024, remaining))
+                if not data:
+                    break
+                f.write(data)
+                remaining -= len(data)
+                upload_bytes_metric.inc(len(data))
+        received = os.path.getsize(job['input_path'])
+        jobs.update(job_id, last_accessed=time.time())
+        
+        start_upload_processing(job_id, job, received)
+    
+    return jsonify({'received': received, 'size': total})
+
+def can_start_early(input_path, settings):
+    """Whether a partial upload can be processed while it is still arriving"""
+    # Streamed outputs mux the audio while encoding, which needs the whole input
+    if settings.get('output_format', 'mp4') != 'mp4':
+        return False
+    # Following a growing file needs ffmpeg to decode from a pipe
+    if shutil.which('ffmpeg') is None:
+        return False
+    return bool(is_streamable(input_path, input_path.rsplit('.', 1)[1]))
+
+def estimate_partial_cost(input_path, received, upload_size):
+    """Cost in pixel-frames of a partial upload, or None if it cannot be probed yet"""
+    info = video_info(input_path)
+    if not info or not info['width'] or not info['height']:
+        return None
+    frames = info['frame_count']
+    if not input_path.lower().endswith(('.mp4', '.mov')):
+        # Without an index up front only the frames received so far are counted
+        frames = frames * upload_size / max(1, received)
+    if frames <= 0:
+        return int(upload_size * PIXEL_FRAMES_PER_BYTE)
+    return int(frames * info['width'] * info['height'])
+
+def start_upload_processing(job_id, job, received):
+    """Queue the job once the upload is complete, or earlier if the container allows it"""
+    input_path = job['input_path']
+    complete = received >= job['upload_size']
+    
+    if complete:
+        with uploads_lock:
+            upload_locks.pop(job_id, None)
+    
+    if job_id in upload_events:
+        # Already processing the partial file: just let it read to the end
+        if complete:
+            # The task may have finished or given up since the check above
+            event = upload_events.pop(job_id, None)
+            if event:
+                event.set()
+            jobs.update(job_id, result_key=result_key(input_path, job['settings']))
+        return
+    if job['status'] != 'uploading':
+        return
     
-    job = jobs[job_id]
+    if complete:
+        key = result_key(input_path, job['settings'])
+        duplicate_id = find_duplicate(key)
+        if duplicate_id:
+            os.remove(input_path)
+            jobs.update(job_id, status='duplicate', duplicate_of=duplicate_id)
+            jobs.update(duplicate_id, last_accessed=time.time())
+            return
+        jobs.update(job_id, result_key=key)
+        
+        # Probe the upload so the scheduler can estimate its cost in pixel-frames
+        info = video_info(input_path)
+        estimated_cost = info['frame_count'] * info['width'] * info['height'] if info else None
+        input_complete = None
+    elif received >= EARLY_START_BYTES and can_start_early(input_path, job['settings']):
+        estimated_cost = estimate_partial_cost(input_path, received, job['upload_size'])
+        if estimated_cost is None:
+            # Not decodable yet: try again after the next chunk
+            return
+        input_complete = threading.Event()
+        upload_events[job_id] = input_complete
+    else:
+        return
+    
+    jobs.update(job_id, status='queued', estimated_cost=estimated_cost)
+    # The upload was admitted when it started, so it is not rejected now
+    executor.submit(
+        job_id, process_video_task, job_id, input_path, job['output_path'], job['settings'], input_complete,
+        cost=estimated_cost, force=True
+    )
+
+def job_status(job_id, job):
+    """Public view of a job record"""
     response = {
         'status': job['status'],
         'progress': job['progress'],
+        'fps': job.get('fps', 0),
         'input_file': job['input_file']
     }
     
-    if job['status'] == 'completed':
+    output_format = job.get('settings', {}).get('output_format', 'mp4')
+    if output_format != 'mp4' and job['status'] in ('processing', 'completed'):
+        response['stream_url'] = url_for('stream_output', job_id=job_id)
+    
+    if job['status'] == 'queued':
+        response['queue_position'] = executor.position(job_id)
+    elif job['status'] == 'completed' and output_format != 'hls':
         response['download_url'] = url_for('download_file', job_id=job_id)
     elif job['status'] == 'failed':
         response['error'] = job.get('error', 'Unknown error')
+    elif job['status'] == 'expired':
+        response['error'] = 'The processed video is no longer stored on the server'
+    
+    if job.get('performance'):
+        response['performance'] = job['performance']
+    
+    return response
+
+@app.route('/status/<job_id>')
+def get_status(job_id):
+    job_id, job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job_status(job_id, job))
+
+@app.route('/events/<job_id>')
+def job_events(job_id):
+    """Stream job status updates as Server-Sent Events until the job finishes"""
+    job_id, job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
     
-    return jsonify(response)
+    def stream():
+        version = None
+        last_status = None
+        while True:
+            # Queue positions change without job updates, so re-check queued jobs periodically
+            timeout = 2.0 if last_status and last_status['status'] == 'queued' else EVENTS_KEEPALIVE_SECONDS
+            version, job = jobs.wait_for_update(job_id, version, timeout)
+            if job is None:
+                return
+            
+            status = job_status(job_id, job)
+            if status != last_status:
+                yield f"data: {json.dumps(status)}\n\n"
+                last_status = status
+            else:
+                yield ": keep-alive\n\n"
+            
+            if job['status'] in ('completed', 'failed', 'expired'):
+                return
+            # Updates arriving in the meantime are coalesced into the next event
+            time.sleep(EVENTS_MIN_INTERVAL)
+    
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/download/<job_id>')
 def download_file(job_id):
-    if job_id not in jobs:
+    job_id, job = find_job(job_id)
+    if job is None:
         return jsonify({'error': 'Job not found'}), 404
     
-    job = jobs[job_id]
+    if job['status'] == 'expired':
+        return jsonify({'error': 'The processed video is no longer stored on the server'}), 410
     if job['status'] != 'completed':
         return jsonify({'error': 'Video processing not completed'}), 400
     
+    if job.get('settings', {}).get('output_format') == 'hls':
+        return jsonify({'error': 'HLS output is served from the stream URL'}), 400
+    
     output_filename = job['output_file']
     output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
     
     if not os.path.exists(output_path):
         return jsonify({'error': 'Output file not found'}), 404
     
+    jobs.update(job_id, last_accessed=time.time())
     return send_file(
         output_path,
         as_attachment=True,
-        download_name=f"blurred_{job['input_file']}"
+        download_name=f"blurred_{Path(job['input_file']).stem}{Path(output_filename).suffix}"
     )
 
+@app.route('/stream/<job_id>')
+@app.route('/stream/<job_id>/<path:filename>')
+def stream_output(job_id, filename=None):
+    """Serve progressive output (fragmented MP4 or HLS) while the job is running"""
+    job_id, job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    jobs.update(job_id, last_accessed=time.time())
+    
+    output_format = job.get('settings', {}).get('output_format', 'mp4')
+    if output_format == 'mp4':
+        return jsonify({'error': 'Job output is not streamable'}), 400
+    if job['status'] not in ('processing', 'completed'):
+        return jsonify({'error': 'Video processing has not started'}), 400
+    
+    output_path = job['output_path']
+    if output_format == 'hls':
+        filename = filename or os.path.basename(output_path)
+        # send_from_directory rejects paths outside the job folder
+        response = send_from_directory(os.path.dirname(output_path), filename)
+        if filename.endswith('.m3u8'):
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    if filename is not None or not os.path.exists(output_path):
+        return jsonify({'error': 'Output file not found'}), 404
+    # Range requests are answered from the bytes written so far
+    response = send_file(output_path, mimetype='video/mp4', conditional=True, max_age=0)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/health')
 def health():
     return jsonify({'status': 'healthy'})
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of queue, job, detector and storage metrics"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
 if __name__ == '__main__':
+    resume_unfinished_jobs()
+    threading.Thread(target=storage_janitor, name='defaceit-storage-janitor', daemon=True).start()
     app.run(host='0.0.0.0', port=8080, debug=False)